@@ -0,0 +1,142 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+# Author: Ryan
+
+"""
+Streaming anomaly detection over classified log lines.
+
+Every level and every (level, template) pair keeps an EWMA of its count
+per interval along with an EWMA of the variance.  An alert fires when the
+count of the current interval rises more than threshold standard
+deviations above the baseline, and when a template shows up that has not
+been seen before.  Each event costs O(1); template baselines are kept in
+LRU order and the coldest ones are evicted past max_templates, so an
+evicted template that comes back is reported as new again.
+"""
+
+import time
+from math import sqrt
+from collections import namedtuple, OrderedDict
+
+from readlog import log_level, log_template
+
+# after this many empty intervals a baseline has decayed as far as it
+# usefully can, so folding stops there
+MAX_IDLE_FOLDS = 64
+
+Alert = namedtuple('Alert', 'kind level template count mean std')
+
+
+def format_alert(alert):
+    if alert.kind == 'new':
+        return 'new template [%s] %s' % (alert.level, alert.template)
+    what = alert.template or 'all %s lines' % alert.level
+    return 'rate spike [%s] %s: %d per interval, baseline %.1f +- %.1f' % (
+        alert.level, what, alert.count, alert.mean, alert.std)
+
+
+class Baseline(object):
+    '''EWMA mean and variance of the per interval count of one key'''
+    __slots__ = ('interval', 'count', 'mean', 'var', 'folds', 'alerted')
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.count = 0
+        self.mean = 0.0
+        self.var = 0.0
+        self.folds = 0
+        self.alerted = False
+
+    def fold(self, value, alpha):
+        diff = value - self.mean
+        incr = alpha * diff
+        self.mean += incr
+        self.var = (1 - alpha) * (self.var + diff * incr)
+        self.folds += 1
+
+    def advance(self, interval, alpha):
+        '''closes the intervals between the current one and interval'''
+        if interval == self.interval:
+            return
+        self.fold(self.count, alpha)
+        for idle in xrange(min(interval - self.interval - 1, MAX_IDLE_FOLDS)):
+            self.fold(0, alpha)
+        self.interval = interval
+        self.count = 0
+        self.alerted = False
+
+
+class AnomalyDetector(object):
+    '''flags rate spikes per level and per template, and new templates
+
+    interval is the length of a counting interval in seconds, alpha the
+    EWMA weight of the newest interval, threshold the number of standard
+    deviations that counts as a spike.  no spike is reported before a
+    baseline has warmup intervals behind it or for counts under min_count,
+    and no template is reported as new during the first warmup intervals.
+    '''
+    def __init__(self, interval=60.0, alpha=0.1, threshold=3.0, min_count=5,
+                 warmup=5, max_templates=10000, clock=time.time):
+        self.interval = interval
+        self.alpha = alpha
+        self.threshold = threshold
+        self.min_count = min_count
+        self.warmup = warmup
+        self.max_templates = max_templates
+        self.clock = clock
+        self.started = None
+        self.levels = {}
+        self.templates = OrderedDict()
+
+    def observe(self, level, template, now=None):
+        '''counts one event, returns the list of alerts it triggered'''
+        if now is None:
+            now = self.clock()
+        interval = int(now // self.interval)
+        if self.started is None:
+            self.started = interval
+        alerts = []
+
+        baseline = self.levels.get(level)
+        if baseline is None:
+            baseline = self.levels[level] = Baseline(interval)
+        self._count(baseline, interval, level, None, alerts)
+
+        key = (level, template)
+        baseline = self.templates.pop(key, None)
+        if baseline is None:
+            baseline = Baseline(interval)
+            if interval - self.started >= self.warmup:
+                alerts.append(Alert('new', level, template, 1, 0.0, 0.0))
+            if len(self.templates) >= self.max_templates:
+                self.templates.popitem(last=False)
+        self.templates[key] = baseline
+        self._count(baseline, interval, level, template, alerts)
+        return alerts
+
+    def _count(self, baseline, interval, level, template, alerts):
+        baseline.advance(interval, self.alpha)
+        baseline.count += 1
+        if baseline.alerted or baseline.folds < self.warmup:
+            return
+        std = sqrt(baseline.var)
+        if (baseline.count >= self.min_count and
+            baseline.count > baseline.mean + self.threshold * std):
+            baseline.alerted = True
+            alerts.append(Alert('spike', level, template, baseline.count,
+                                baseline.mean, std))
+
+    def observe_line(self, line, now=None):
+        return self.observe(log_level(line), log_template(line), now)
+
+    def process(self, logs):
+        '''yields the alerts for an iterable of log lines'''
+        for line in logs:
+            for alert in self.observe_line(line):
+                yield alert
+
+if __name__ == "__main__":
+    import sys
+    from readlog import Readlog
+    for alert in AnomalyDetector().process(Readlog(sys.argv[1])):
+        print format_alert(alert)
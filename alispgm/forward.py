@@ -0,0 +1,261 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+# Author: Ryan
+
+"""
+Forwards classified log events to a central HTTP collector.
+
+Events are batched by count, size and age, sent as gzipped newline
+delimited JSON over one keep-alive connection, and retried with backoff.
+A collector answering 429 or 503 is waited for (honouring Retry-After).
+Batches that still cannot be delivered are kept in a spool directory and
+sent again, oldest first, after the next successful delivery.
+"""
+
+import os
+import time
+import json
+import gzip
+import socket
+import httplib
+import logging
+from glob import glob
+from email.utils import parsedate_tz, mktime_tz
+from urlparse import urlsplit
+from cStringIO import StringIO
+from threading import Thread, Lock, Event
+
+from readlog import classifylog
+
+log = logging.getLogger('alispgm')
+
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+BACKPRESSURE_STATUS = (429, 503)
+
+
+class DeliveryError(Exception):
+    def __init__(self, reason, status=None, retry_after=None):
+        Exception.__init__(self, reason)
+        self.reason = reason
+        self.status = status
+        self.retry_after = retry_after
+
+
+def retry_after_seconds(value):
+    '''the seconds a Retry-After header asks for, given either as seconds
+    or as an HTTP date; None when it is neither'''
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, mktime_tz(date) - time.time())
+
+def gzip_lines(lines):
+    buf = StringIO()
+    gz = gzip.GzipFile(fileobj=buf, mode='wb')
+    gz.writelines(lines)
+    gz.close()
+    return buf.getvalue()
+
+def analysis_events(timenow, counts):
+    '''turns the result of classifylog into events for the collector'''
+    stamp = timenow.isoformat()
+    for (level, template), count in counts.iteritems():
+        yield {'time': stamp, 'level': level, 'template': template,
+               'count': count}
+
+
+class HTTPForwarder(object):
+    '''batches events and posts them to url
+
+    a batch is sent when it holds max_events events, reaches max_bytes of
+    uncompressed JSON, or is older than flush_interval seconds.  the age
+    check happens on send(), and also in the background after start().
+    delivery and its retries happen outside the lock send() takes, so
+    senders are not held up while a batch is being retried.
+    '''
+    def __init__(self, url, spool_dir, max_events=1000, max_bytes=1 << 20,
+                 flush_interval=5.0, retries=3, backoff=1.0, max_wait=60.0,
+                 timeout=10.0, max_spool=1000):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path or '/'
+        if parts.query:
+            self.path += '?' + parts.query
+        if parts.scheme == 'https':
+            self.Connection = httplib.HTTPSConnection
+        else:
+            self.Connection = httplib.HTTPConnection
+        self.spool_dir = spool_dir
+        if not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir)
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.backoff = backoff
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.max_spool = max_spool
+        self.conn = None
+        self.batch = []
+        self.batch_bytes = 0
+        self.batch_started = None
+        self.spool_seq = 0
+        self.lock = Lock()
+        self.delivery_lock = Lock()
+        self.stopping = Event()
+        self.flusher = None
+
+    def send(self, event):
+        '''adds an event (a dict) to the current batch'''
+        line = json.dumps(event, separators=(',', ':')) + '\n'
+        with self.lock:
+            if not self.batch:
+                self.batch_started = time.time()
+            self.batch.append(line)
+            self.batch_bytes += len(line)
+            payload = None
+            if (len(self.batch) >= self.max_events or
+                self.batch_bytes >= self.max_bytes or
+                time.time() - self.batch_started >= self.flush_interval):
+                payload = self._take_batch()
+        if payload:
+            self._ship(payload)
+
+    def send_analysis(self, logs):
+        '''classifies an iterable of log lines and sends one event per
+        level and template'''
+        timenow, counts = classifylog(logs)
+        for event in analysis_events(timenow, counts):
+            self.send(event)
+
+    def flush(self):
+        with self.lock:
+            payload = self._take_batch()
+        if payload:
+            self._ship(payload)
+
+    def _take_batch(self):
+        '''empties the current batch, returns it gzipped; call with the
+        lock held'''
+        if not self.batch:
+            return None
+        payload = gzip_lines(self.batch)
+        self.batch = []
+        self.batch_bytes = 0
+        self.batch_started = None
+        return payload
+
+    def _ship(self, payload):
+        '''delivers a payload, or spools it; call without the lock held'''
+        with self.delivery_lock:
+            if self._deliver(payload):
+                self._replay_spool()
+            else:
+                self._spool(payload)
+
+    def _deliver(self, payload):
+        '''posts one payload, retrying; returns whether it got through'''
+        delay = self.backoff
+        for attempt in xrange(self.retries + 1):
+            try:
+                self._post(payload)
+                return True
+            except DeliveryError, e:
+                if e.status and e.status not in RETRY_STATUS:
+                    log.error('collector rejected batch: %s' % e.reason)
+                    return True
+                log.warning('delivery failed: %s' % e.reason)
+                wait = delay
+                if e.retry_after is not None:
+                    wait = max(wait, e.retry_after)
+                if attempt < self.retries:
+                    if self.stopping.wait(min(wait, self.max_wait)):
+                        break
+                delay *= 2
+        return False
+
+    def _post(self, payload):
+        if self.conn is None:
+            self.conn = self.Connection(self.host, self.port,
+                                        timeout=self.timeout)
+        headers = {'Content-Type': 'application/x-ndjson',
+                   'Content-Encoding': 'gzip',
+                   'Connection': 'keep-alive'}
+        try:
+            self.conn.request('POST', self.path, payload, headers)
+            response = self.conn.getresponse()
+            response.read()
+        except (httplib.HTTPException, socket.error), e:
+            self.conn.close()
+            self.conn = None
+            raise DeliveryError(str(e) or e.__class__.__name__)
+        if response.getheader('connection', '').lower() == 'close':
+            self.conn.close()
+            self.conn = None
+        if 200 <= response.status < 300:
+            return
+        retry_after = None
+        if response.status in BACKPRESSURE_STATUS:
+            retry_after = retry_after_seconds(
+                response.getheader('retry-after', ''))
+        raise DeliveryError('%d %s' % (response.status, response.reason),
+                            response.status, retry_after)
+
+    def _spool_files(self):
+        return sorted(glob(os.path.join(self.spool_dir, 'batch-*.ndjson.gz')))
+
+    def _spool(self, payload):
+        self.spool_seq += 1
+        name = 'batch-%017.6f-%06d.ndjson.gz' % (time.time(), self.spool_seq)
+        tmp = os.path.join(self.spool_dir, '.' + name)
+        fh = open(tmp, 'wb')
+        fh.write(payload)
+        fh.close()
+        os.rename(tmp, os.path.join(self.spool_dir, name))
+        spooled = self._spool_files()
+        for old in spooled[:max(0, len(spooled) - self.max_spool)]:
+            log.error('spool full, dropping %s' % old)
+            os.remove(old)
+
+    def _replay_spool(self):
+        for name in self._spool_files():
+            fh = open(name, 'rb')
+            payload = fh.read()
+            fh.close()
+            if not self._deliver(payload):
+                break
+            os.remove(name)
+
+    def _run_flusher(self):
+        while not self.stopping.wait(self.flush_interval / 2.0):
+            payload = None
+            with self.lock:
+                if (self.batch and
+                    time.time() - self.batch_started >= self.flush_interval):
+                    payload = self._take_batch()
+            if payload:
+                self._ship(payload)
+
+    def start(self):
+        '''flushes aged batches in the background'''
+        self.flusher = Thread(target=self._run_flusher)
+        self.flusher.setDaemon(True)
+        self.flusher.start()
+
+    def close(self):
+        '''sends what is left and closes the connection'''
+        self.flush()
+        self.stopping.set()
+        if self.flusher:
+            self.flusher.join()
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,293 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+# Author: Ryan
+
+"""
+Local ingest service for hosts that ship their logs over the network.
+
+Accepts syslog (RFC 5424 and RFC 3164) over UDP and TCP, and newline
+delimited JSON over a unix socket.  Received messages are turned into plain
+log lines, queued in a bounded queue and handed to analysislog in batches.
+When the queue is full, UDP messages (which cannot be slowed down) and TCP
+messages that waited too long are spilled to a segment file and replayed
+in batches once the queue has drained.
+"""
+
+import os
+import re
+import json
+import time
+import Queue
+import SocketServer
+from itertools import islice
+from threading import Thread, Lock, Event
+
+from readlog import analysislog
+
+# syslog severities 0-7 mapped to the level names analysislog looks for
+SEVERITY_LEVELS = ('ERROR', 'ERROR', 'ERROR', 'ERROR', 'WARNING',
+                   'INFO', 'INFO', 'DEBUG')
+
+RFC5424 = re.compile(r'^<(?P<pri>\d{1,3})>\d{1,2} (?P<time>\S+) (?P<host>\S+) '
+                     r'(?P<app>\S+) \S+ \S+ (?:-|(?:\[(?:[^\]\\]|\\.)*\])+)'
+                     r' ?(?P<msg>.*)$', re.S)
+RFC3164 = re.compile(r'^<(?P<pri>\d{1,3})>(?P<time>[A-Z][a-z]{2} [ \d]\d '
+                     r'\d\d:\d\d:\d\d) (?P<host>\S+) (?P<app>[^:\[ ]+)'
+                     r'(?:\[\d+\])?:? ?(?P<msg>.*)$', re.S)
+OCTET_COUNT = re.compile(r'^\d+ (?=<)')
+
+
+def format_line(stamp, host, app, level, msg):
+    return '%s %s %s %s: %s\n' % (stamp, host, app, level, msg.rstrip('\r\n'))
+
+def parse_syslog(data):
+    '''turns a syslog message into a log line, tagging it with the level
+    name for its severity'''
+    data = OCTET_COUNT.sub('', data.lstrip('\0'))
+    if data.startswith('\xef\xbb\xbf'):
+        data = data[3:]
+    found = RFC5424.match(data) or RFC3164.match(data)
+    if not found:
+        return data.rstrip('\r\n') + '\n'
+    level = SEVERITY_LEVELS[int(found.group('pri')) & 7]
+    msg = found.group('msg')
+    if msg.startswith('\xef\xbb\xbf'):
+        msg = msg[3:]
+    return format_line(found.group('time'), found.group('host'),
+                       found.group('app'), level, msg)
+
+def parse_json(data):
+    '''turns one line of JSON into a log line'''
+    try:
+        event = json.loads(data)
+    except ValueError:
+        return data.rstrip('\r\n') + '\n'
+    if not isinstance(event, dict):
+        return data.rstrip('\r\n') + '\n'
+    msg = event.get('message', event.get('msg', ''))
+    line = format_line(event.get('time', event.get('timestamp', '-')),
+                       event.get('host', '-'), event.get('app', '-'),
+                       str(event.get('level', 'INFO')).upper(), unicode(msg))
+    if isinstance(line, unicode):
+        line = line.encode('utf-8')
+    return line
+
+
+class IngestQueue(object):
+    '''a bounded queue of log lines that spills to a segment file when full
+
+    while something spilled is waiting, lines that cannot wait (udp) go to
+    the segment file as well, so they stay in arrival order; lines that can
+    wait still wait for room in the queue, up to their timeout, so their
+    senders are slowed down.  once the queue is down to low_water lines
+    (half of maxsize), spilling stops; the lines queued until then are
+    taken first, then the segment file is replayed, in batches, before the
+    lines queued since
+    '''
+    def __init__(self, maxsize, spool):
+        self.queue = Queue.Queue(maxsize)
+        self.low_water = maxsize // 2
+        self.spool = spool
+        self.spilled = 0
+        self.spilling = False
+        # queued lines that are older than the spilled ones
+        self.ahead = 0
+        self.segment = None
+        self.segment_name = None
+        self.lock = Lock()
+
+    def put(self, line, timeout=None):
+        '''queues a line, waiting up to timeout seconds for room
+
+        with a timeout of None it does not wait at all
+        '''
+        with self.lock:
+            if not self.spilling:
+                try:
+                    self.queue.put_nowait(line)
+                    return
+                except Queue.Full:
+                    pass
+            if timeout is None:
+                self._spill(line)
+                return
+        try:
+            self.queue.put(line, True, timeout)
+        except Queue.Full:
+            with self.lock:
+                self._spill(line)
+
+    def _spill(self, line):
+        segment = open(self.spool, 'a')
+        segment.write(line)
+        segment.close()
+        self.spilled += 1
+        self.spilling = True
+
+    def replay(self, size):
+        '''takes up to size spilled lines back, once the lines ahead of
+        them are taken'''
+        # only the consumer reads the segment, new lines spill to a new one
+        if self.segment is None:
+            if self.ahead or self.segment_name is None:
+                return []
+            self.segment = open(self.segment_name)
+            self.segment_name = None
+        lines = list(islice(self.segment, size))
+        if len(lines) < size:
+            self.segment.close()
+            os.remove(self.segment.name)
+            self.segment = None
+        return lines
+
+    def get_batch(self, size, interval):
+        '''waits up to interval seconds for up to size lines'''
+        if self.segment is None and self.ahead:
+            batch = []
+            while len(batch) < min(size, self.ahead):
+                batch.append(self.queue.get_nowait())
+            self.ahead -= len(batch)
+            return batch
+        batch = self.replay(size)
+        if batch:
+            return batch
+        deadline = time.time() + interval
+        while len(batch) < size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(True, remaining))
+            except Queue.Empty:
+                break
+        # steady traffic may never leave the queue empty, so spilling stops
+        # as soon as it is down to low_water
+        with self.lock:
+            if self.spilling and self.queue.qsize() <= self.low_water:
+                self.spilling = False
+                self.ahead = self.queue.qsize()
+                if self.spilled:
+                    self.segment_name = '%s.%d' % (self.spool, os.getpid())
+                    os.rename(self.spool, self.segment_name)
+                    self.spilled = 0
+        if not batch:
+            batch = self.replay(size)
+        return batch
+
+
+class SyslogUDPHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        data = self.request[0]
+        for message in data.splitlines():
+            if message.strip():
+                self.server.ingest.put(parse_syslog(message))
+
+
+class SyslogTCPHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        ingest = self.server.ingest
+        for message in self.rfile:
+            if message.strip():
+                ingest.put(parse_syslog(message), self.server.put_timeout)
+
+
+class JSONHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        ingest = self.server.ingest
+        for message in self.rfile:
+            if message.strip():
+                ingest.put(parse_json(message), self.server.put_timeout)
+
+
+class UDPServer(SocketServer.ThreadingUDPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class TCPServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class UnixServer(SocketServer.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class IngestServer(object):
+    '''runs the listeners and feeds received lines to the analysis in batches
+
+    udp and tcp are (host, port) tuples, unix is a socket path; any of them
+    can be left out.  callback is called with the result of analysislog for
+    every batch.
+    '''
+    def __init__(self, callback, udp=None, tcp=None, unix=None,
+                 spool='ingest.segment', maxsize=10000, batch_size=500,
+                 batch_interval=1.0, put_timeout=5.0, analyze=analysislog):
+        self.callback = callback
+        self.analyze = analyze
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.ingest = IngestQueue(maxsize, spool)
+        self.servers = []
+        self.threads = []
+        self.stopping = Event()
+        for address, Server, Handler in ((udp, UDPServer, SyslogUDPHandler),
+                                         (tcp, TCPServer, SyslogTCPHandler),
+                                         (unix, UnixServer, JSONHandler)):
+            if address is None:
+                continue
+            if Server is UnixServer and os.path.exists(address):
+                os.remove(address)
+            server = Server(address, Handler)
+            server.ingest = self.ingest
+            server.put_timeout = put_timeout
+            self.servers.append(server)
+
+    @property
+    def addresses(self):
+        '''the bound addresses, useful when listening on port 0'''
+        return [server.server_address for server in self.servers]
+
+    def start(self):
+        for server in self.servers:
+            self._spawn(server.serve_forever)
+        self._spawn(self.consume)
+
+    def _spawn(self, target):
+        thread = Thread(target=target)
+        thread.setDaemon(True)
+        thread.start()
+        self.threads.append(thread)
+
+    def consume(self):
+        while True:
+            batch = self.ingest.get_batch(self.batch_size, self.batch_interval)
+            if batch:
+                self.callback(self.analyze(batch))
+            elif self.stopping.isSet():
+                break
+
+    def stop(self):
+        '''stops listening and waits until everything received is analysed'''
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+            if isinstance(server, UnixServer):
+                os.remove(server.server_address)
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+
+    def serve(self):
+        self.start()
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            self.stop()
+
+if __name__ == "__main__":
+    def show(loginfo):
+        print loginfo
+    IngestServer(show, udp=('127.0.0.1', 5514), tcp=('127.0.0.1', 5514),
+                 unix='/tmp/alispgm.sock').serve()
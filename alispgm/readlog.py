@@ -2,6 +2,7 @@
 #-*- coding: utf-8 -*-
 # Author: Ryan
 
+import re
 from os import stat
 from os.path import exists, getsize
 import glob
@@ -132,7 +133,7 @@ class Readlog(object):
         # no match
         return None
 
-def analysislog(logs):
+def analysislog(logs, sketches=None):
     timenow = datetime.now()
     error_num = 0
     warning_num = 0
@@ -141,6 +142,8 @@ def analysislog(logs):
     errors = []
 #    debugs = []
     for log in logs:
+        if sketches is not None:
+            sketches.feed(log)
         if 'INFO' in log:
             info_num += 1
         elif 'WARNING' in log:
@@ -156,6 +159,36 @@ def analysislog(logs):
 #    return (timenow, info_num, warning_num, error_num, d_n, errors, debugs)
     return (timenow, info_num, warning_num, error_num, errors)
 
+LEVELS = ('INFO', 'WARNING', 'ERROR', 'DEBUG')
+
+# variable parts of a line, masked so similar lines share one template
+TEMPLATE_MASKS = [(re.compile(r'\b\d{1,3}(?:\.\d{1,3}){3}(?::\d+)?\b'), '<ip>'),
+                  (re.compile(r'\b0x[0-9a-fA-F]+\b|\b(?=[0-9a-fA-F]*\d)(?=[0-9a-fA-F]*[a-fA-F])[0-9a-fA-F]{6,}\b'), '<hex>'),
+                  (re.compile(r'\d+'), '<num>')]
+
+def log_level(log):
+    '''the level of a line, checked in the same order as analysislog'''
+    for level in LEVELS:
+        if level in log:
+            return level
+    return 'OTHER'
+
+def log_template(log):
+    '''the line with numbers, addresses and ids masked'''
+    template = log.strip()
+    for regex, mask in TEMPLATE_MASKS:
+        template = regex.sub(mask, template)
+    return template
+
+def classifylog(logs):
+    '''counts lines by (level, template)'''
+    timenow = datetime.now()
+    counts = {}
+    for log in logs:
+        key = (log_level(log), log_template(log))
+        counts[key] = counts.get(key, 0) + 1
+    return (timenow, counts)
+
 if __name__ == "__main__":
     import datetime
     print datetime.datetime.now()
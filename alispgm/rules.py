@@ -0,0 +1,182 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+# Author: Ryan
+
+"""
+Declarative alert rules for the log analysis.
+
+A rule file is an INI file, one section per rule:
+
+    [db-timeout]
+    level = ERROR
+    match = db timeout
+    threshold = 50
+    window = 300
+    message = database timeouts are piling up
+
+level, match and exclude are regexes.  A rule with a window fires when more
+than threshold lines matched within the last window seconds; a rule without
+a window fires at the end of the run when more than threshold lines matched
+in total.  Optional timestamp/timeformat options in [DEFAULT] (or per rule)
+take the event time from the line itself instead of the wall clock.
+"""
+
+import re
+import time
+from collections import deque
+from ConfigParser import RawConfigParser
+
+from devshell.base.awk import (RegexPattern, AndPattern, NotPattern, Action,
+                               AwkProgram, End)
+
+
+class RuleError(Exception):
+    def __init__(self, rule, reason):
+        Exception.__init__(self, '%s: %s' % (rule, reason))
+        self.rule = rule
+        self.reason = reason
+
+
+class Rule(object):
+    '''a single alert condition read from a rule file'''
+    def __init__(self, name, level=None, match=None, exclude=None,
+                 threshold=0, window=None, message=None,
+                 timestamp=None, timeformat=None):
+        if not (level or match):
+            raise RuleError(name, 'needs at least one of level or match')
+        if bool(timestamp) != bool(timeformat):
+            raise RuleError(name, 'timestamp and timeformat go together')
+        self.name = name
+        self.level = level
+        self.match = match
+        self.exclude = exclude
+        self.threshold = int(threshold)
+        self.window = window and float(window) or None
+        self.message = message or name
+        self.timestamp = timestamp
+        self.timeformat = timeformat
+
+    def pattern(self):
+        '''builds the devshell.base.awk pattern for this rule'''
+        patterns = [RegexPattern(regex) for regex in (self.level, self.match)
+                    if regex]
+        if self.exclude:
+            patterns.insert(0, NotPattern(RegexPattern(self.exclude)))
+        pattern = patterns[-1]
+        for first in reversed(patterns[:-1]):
+            pattern = AndPattern(first, pattern)
+        return pattern
+
+
+class WindowCountHandler(object):
+    '''counts matching lines over a sliding time window
+
+    yields one alert line when the count within the window goes above the
+    threshold, then stays quiet until the window has drained below it again
+    '''
+    def __init__(self, rule, clock=time.time):
+        self.rule = rule
+        self.clock = clock
+        self.times = deque()
+        self.firing = False
+        if rule.timestamp:
+            self.timestamp = re.compile(rule.timestamp)
+        else:
+            self.timestamp = None
+
+    def event_time(self, line):
+        '''the time of the line, or the clock when it has none that fits
+        timeformat, eg. a continuation line'''
+        if self.timestamp:
+            found = self.timestamp.search(line)
+            if found:
+                stamp = found.group(found.lastindex or 0)
+                try:
+                    return time.mktime(time.strptime(stamp,
+                                                     self.rule.timeformat))
+                except ValueError:
+                    pass
+        return self.clock()
+
+    def __call__(self, awk, match, line):
+        now = self.event_time(line)
+        times = self.times
+        times.append(now)
+        while times and times[0] <= now - self.rule.window:
+            times.popleft()
+        if len(times) > self.rule.threshold:
+            if not self.firing:
+                self.firing = True
+                yield '[%s] %s: %d matches in %ds, last: %s' % (
+                    self.rule.name, self.rule.message, len(times),
+                    self.rule.window, line.rstrip('\n'))
+        else:
+            self.firing = False
+
+
+class TotalCountHandler(object):
+    '''counts every matching line for a rule without a window'''
+    def __init__(self, rule):
+        self.rule = rule
+        self.count = 0
+
+    def __call__(self, awk, match, line):
+        self.count += 1
+        return None
+
+
+class ReportTotalHandler(object):
+    '''End handler reporting rules whose total count exceeded the threshold'''
+    def __init__(self, counter):
+        self.counter = counter
+
+    def __call__(self, awk, match, line):
+        rule = self.counter.rule
+        if self.counter.count > rule.threshold:
+            yield '[%s] %s: %d matches' % (rule.name, rule.message,
+                                           self.counter.count)
+
+
+RULE_OPTIONS = ('level', 'match', 'exclude', 'threshold', 'window', 'message',
+                'timestamp', 'timeformat')
+
+def load_rules(filename):
+    '''reads an INI rule file and returns a list of Rule objects'''
+    parser = RawConfigParser()
+    if not parser.read(filename):
+        raise IOError('cannot read rule file %s' % filename)
+    rules = []
+    for section in parser.sections():
+        options = dict(parser.items(section))
+        unknown = set(options) - set(RULE_OPTIONS)
+        if unknown:
+            raise RuleError(section, 'unknown options %s' % ', '.join(sorted(unknown)))
+        rules.append(Rule(section, **options))
+    return rules
+
+def RulesProgram(rules, clock=time.time):
+    '''compiles a list of rules to an AwkProgram'''
+    program = AwkProgram()
+    for rule in rules:
+        if rule.window:
+            program.add_action(Action(rule.pattern(), WindowCountHandler(rule, clock)))
+        else:
+            counter = TotalCountHandler(rule)
+            program.add_action(Action(rule.pattern(), counter))
+            program.add_action(Action(End, ReportTotalHandler(counter)))
+    return program
+
+def check_rules(rules, logs):
+    '''runs the rules over an iterable of log lines, eg. a Readlog, and
+    returns the list of alerts'''
+    program = RulesProgram(rules)
+    return list(program()(logs))
+
+if __name__ == "__main__":
+    import sys
+    from readlog import Readlog
+    if len(sys.argv) != 3:
+        print "usage: %s rules.ini logfile" % sys.argv[0]
+        sys.exit(1)
+    for alert in check_rules(load_rules(sys.argv[1]), Readlog(sys.argv[2])):
+        print alert
@@ -0,0 +1,258 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+# Author: Ryan
+
+"""
+Probabilistic aggregates for the log analysis.
+
+HeavyHitters (a Count-Min sketch plus the k best candidates) answers "top
+client IPs producing errors", HyperLogLog answers "how many distinct users
+were affected", both in fixed memory.  Sketches built with the same
+parameters can be merged, so results from several files or several
+workers combine, and they serialize to JSON so the aggregate state can be
+kept between runs.
+"""
+
+import re
+import json
+import struct
+from os.path import exists, getsize
+from math import log as ln
+from array import array
+from base64 import b64encode, b64decode
+from hashlib import md5
+
+
+def hash128(item):
+    '''two 64 bit hashes of item'''
+    if isinstance(item, unicode):
+        item = item.encode('utf-8')
+    return struct.unpack('<QQ', md5(item).digest())
+
+
+class SketchError(Exception):
+    pass
+
+
+class CountMinSketch(object):
+    '''approximate counts, never below the true count
+
+    the overestimate is at most 2/width of the total with probability
+    1 - 2**-depth
+    '''
+    def __init__(self, width=2048, depth=5):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('l', [0]) * width for row in xrange(depth)]
+
+    def _cells(self, item):
+        h1, h2 = hash128(item)
+        width = self.width
+        return [(h1 + row * h2) % width for row in xrange(self.depth)]
+
+    def add(self, item, count=1):
+        '''adds count to item, returns the new estimate'''
+        estimate = None
+        for row, cell in zip(self.rows, self._cells(item)):
+            row[cell] += count
+            if estimate is None or row[cell] < estimate:
+                estimate = row[cell]
+        return estimate
+
+    def estimate(self, item):
+        return min(row[cell] for row, cell in zip(self.rows, self._cells(item)))
+
+    def merge(self, other):
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise SketchError('cannot merge sketches of different sizes')
+        for row, other_row in zip(self.rows, other.rows):
+            for cell in xrange(self.width):
+                row[cell] += other_row[cell]
+
+    def to_dict(self):
+        return {'width': self.width, 'depth': self.depth,
+                'rows': [b64encode(row.tostring()) for row in self.rows]}
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state['width'], state['depth'])
+        for row, data in zip(sketch.rows, state['rows']):
+            row[:] = array('l', b64decode(data))
+        return sketch
+
+
+class HeavyHitters(object):
+    '''the k items with the highest (estimated) counts'''
+    def __init__(self, k=10, width=2048, depth=5):
+        self.k = k
+        self.sketch = CountMinSketch(width, depth)
+        self.top = {}
+        self.floor = 0
+
+    def add(self, item, count=1):
+        estimate = self.sketch.add(item, count)
+        top = self.top
+        if item in top or len(top) < self.k:
+            top[item] = estimate
+        elif estimate > self.floor:
+            coldest = min(top, key=top.get)
+            if estimate > top[coldest]:
+                del top[coldest]
+                top[item] = estimate
+            self.floor = min(top.itervalues())
+
+    def items(self):
+        '''(item, estimated count) pairs, highest count first'''
+        return sorted(self.top.iteritems(), key=lambda x: (-x[1], x[0]))
+
+    def merge(self, other):
+        self.sketch.merge(other.sketch)
+        candidates = set(self.top) | set(other.top)
+        counts = [(self.sketch.estimate(item), item) for item in candidates]
+        counts.sort(reverse=True)
+        self.top = dict((item, count) for count, item in counts[:self.k])
+        self.floor = self.top and min(self.top.itervalues()) or 0
+
+    def to_dict(self):
+        return {'k': self.k, 'sketch': self.sketch.to_dict(),
+                'top': self.top.items()}
+
+    @classmethod
+    def from_dict(cls, state):
+        hitters = cls(state['k'])
+        hitters.sketch = CountMinSketch.from_dict(state['sketch'])
+        hitters.top = dict(state['top'])
+        hitters.floor = hitters.top and min(hitters.top.itervalues()) or 0
+        return hitters
+
+
+class HyperLogLog(object):
+    '''approximate number of distinct items, standard error 1.04/sqrt(2**p)'''
+    def __init__(self, p=14):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+
+    def add(self, item):
+        h = hash128(item)[0]
+        index = h >> (64 - self.p)
+        rest = (h << self.p) & 0xffffffffffffffff
+        rank = 1
+        while rank <= 64 - self.p and not rest & 0x8000000000000000:
+            rank += 1
+            rest <<= 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        m = self.m
+        if m >= 128:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[m]
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count('\0')
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * ln(float(m) / zeros)
+        return int(round(estimate))
+
+    def merge(self, other):
+        if self.p != other.p:
+            raise SketchError('cannot merge HyperLogLogs of different precision')
+        registers = self.registers
+        for index, rank in enumerate(other.registers):
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def to_dict(self):
+        return {'p': self.p, 'registers': b64encode(str(self.registers))}
+
+    @classmethod
+    def from_dict(cls, state):
+        hll = cls(state['p'])
+        hll.registers = bytearray(b64decode(state['registers']))
+        return hll
+
+
+SKETCH_TYPES = {'heavyhitters': HeavyHitters, 'hyperloglog': HyperLogLog}
+
+
+class FieldExtractor(object):
+    '''pulls the value to aggregate out of a line
+
+    regex is searched in the line and the 'value' group (or else the first
+    group, or else the whole match) is returned; level restricts it to the
+    lines of that level, as found by analysislog
+    '''
+    def __init__(self, regex, level=None):
+        self.regex = re.compile(regex)
+        self.level = level
+
+    def __call__(self, line):
+        if self.level and self.level not in line:
+            return None
+        found = self.regex.search(line)
+        if not found:
+            return None
+        if 'value' in self.regex.groupindex:
+            return found.group('value')
+        return found.group(found.lastindex and 1 or 0)
+
+
+class SketchSet(object):
+    '''named sketches, each fed by its own field extractor
+
+    eg. add('error_ips', HeavyHitters(20),
+            FieldExtractor(r'client (?P<value>[\d.]+)', 'ERROR'))
+    '''
+    def __init__(self):
+        self.sketches = {}
+        self.extractors = {}
+
+    def add(self, name, sketch, extractor):
+        self.sketches[name] = sketch
+        self.extractors[name] = extractor
+
+    def __getitem__(self, name):
+        return self.sketches[name]
+
+    def feed(self, line):
+        for name, extract in self.extractors.iteritems():
+            value = extract(line)
+            if value is not None:
+                self.sketches[name].add(value)
+
+    def merge(self, other):
+        '''merges the sketches of other that have a name in common'''
+        for name, sketch in other.sketches.iteritems():
+            if name in self.sketches:
+                self.sketches[name].merge(sketch)
+
+    def to_dict(self):
+        state = {}
+        for name, sketch in self.sketches.iteritems():
+            for kind, cls in SKETCH_TYPES.iteritems():
+                if isinstance(sketch, cls):
+                    state[name] = {'type': kind, 'state': sketch.to_dict()}
+        return state
+
+    @classmethod
+    def from_dict(cls, state):
+        '''a SketchSet without extractors, good for merging and reporting'''
+        sketches = cls()
+        for name, entry in state.iteritems():
+            sketch = SKETCH_TYPES[entry['type']].from_dict(entry['state'])
+            sketches.add(name, sketch, lambda line: None)
+        return sketches
+
+    def save(self, filename):
+        fh = open(filename, 'w')
+        json.dump(self.to_dict(), fh)
+        fh.close()
+
+    def load(self, filename):
+        '''merges previously saved state into this set'''
+        if exists(filename) and getsize(filename):
+            fh = open(filename)
+            self.merge(SketchSet.from_dict(json.load(fh)))
+            fh.close()
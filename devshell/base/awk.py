@@ -17,7 +17,19 @@
 #
 
 import re
+import logging
+import sre_parse
+from time import time
 from copy import copy
+from Queue import Full
+from collections import OrderedDict
+from heapq import nsmallest
+from itertools import imap
+from sre_constants import LITERAL, SUBPATTERN, MAX_REPEAT, MIN_REPEAT
+
+from devshell.base.awk_matchers import literal_set, literal_test, backtracking_risk
+
+log = logging.getLogger('devshell')
 
 class Either(object):
     def __init__(self, value, right=True):
@@ -48,6 +60,22 @@ class Pattern(object):
         '''
         return True
 
+    def prefilter(self):
+        '''literals a line must contain at least one of to match
+
+        returns a list of str, or None when no such literal is known.  a
+        pattern that is not stateless has none, as a line it rejects must
+        still reach the patterns that keep state
+        '''
+        return None
+
+    def stateless(self):
+        '''whether matching a line is independent of the lines before it
+
+        subclasses that keep state between lines must return False
+        '''
+        return True
+
     def __call__(self, line):
         '''shortcut for match
         '''
@@ -63,11 +91,56 @@ class FalsePattern(Pattern):
     def match(self, line):
         return False
 
+def required_literals(regex_str, flags=0):
+    '''returns the literal substrings every match of the regex contains
+
+    only ascii literals are returned, as str, so they can be looked for in
+    str and unicode lines alike.  case insensitive regexes have none.
+    '''
+    if flags & re.I:
+        return []
+    try:
+        parsed = sre_parse.parse(regex_str, flags)
+    except (re.error, AssertionError):
+        return []
+    if parsed.pattern.flags & re.I:
+        return []
+    literals = []
+    def walk(items):
+        run = []
+        for op, av in items:
+            if op == LITERAL and av < 128:
+                run.append(chr(av))
+                continue
+            if run:
+                literals.append(''.join(run))
+                run = []
+            if op == SUBPATTERN:
+                walk(av[-1])
+            elif op in (MAX_REPEAT, MIN_REPEAT) and av[0] >= 1:
+                walk(av[2])
+        if run:
+            literals.append(''.join(run))
+    walk(parsed)
+    return literals
+
+# shorter literals are found in too many lines to be worth checking first
+MIN_PREFILTER_LEN = 2
+
 class RegexPattern(Pattern):
     '''a specialized pattern that accepts a regex as the matcher
 
     returns the regex MatchObject when matches are found
+
+    whether a regex that is a set of literals (foo|bar) matches is decided
+    without re (see awk_matchers), which then only runs on the lines that
+    match; a single literal does the same through the prefilter.  when
+    max_risky_length is set (it is None by default), a regex that risks
+    exponential backtracking is not run on lines longer than that; those
+    lines are counted in skipped and never match.
     '''
+    max_risky_length = None
+
     def __init__(self, regex_str, flags=0):
         '''creates a RegexPattern
 
@@ -83,13 +156,104 @@ class RegexPattern(Pattern):
         '''
         if not self.is_compiled:
             self._regex = re.compile(self.regex_str, self.flags)
+            literals = required_literals(self.regex_str, self.flags)
+            literals.sort(key=len)
+            if literals and len(literals[-1]) >= MIN_PREFILTER_LEN:
+                self.literal = literals[-1]
+            else:
+                self.literal = None
+            self.test = None
+            self.literals = None
+            if self.literal is None:
+                self.test = literal_test(self.regex_str, self.flags)
+                found = literal_set(self.regex_str, self.flags)
+                if found and min(map(len, found[0])) >= MIN_PREFILTER_LEN:
+                    self.literals = found[0]
+            self.risky = self.test is None and \
+                         backtracking_risk(self.regex_str, self.flags)
+            self.skipped = 0
             self.is_compiled = True
         return self._regex
 
+    def prefilter(self):
+        '''the longest literal the regex requires (see required_literals),
+        or the literals of a set of literals
+        '''
+        self.regex
+        if self.literal is None:
+            return self.literals
+        return [self.literal]
+
     def match(self, line):
         '''returns a MatchObject where a match is found
+
+        lines without the required literal are rejected without running
+        the regex
+        '''
+        if not self.is_compiled:
+            self.regex
+        if self.test is not None:
+            return self.test(line) and self._regex.search(line) or None
+        literal = self.literal
+        if literal is not None and literal not in line:
+            return None
+        if self.risky and self.max_risky_length is not None and \
+           len(line) > self.max_risky_length:
+            return self.skip(line)
+        return self._regex.search(line)
+
+    def skip(self, line):
+        if not self.skipped:
+            log.warning('/%s/ may backtrack for a long time, skipping lines '
+                        'longer than %d' % (self.regex_str, self.max_risky_length))
+        self.skipped += 1
+        return None
+
+    def encoded(self, encoding='utf-8'):
+        '''a copy that matches lines of bytes in encoding
+
+        a unicode regex is encoded and loses re.UNICODE, so it compiles
+        as a byte regex; a str regex is taken to be in encoding already
         '''
-        return self.regex.search(line)
+        pattern = copy(self)
+        if isinstance(self.regex_str, unicode):
+            pattern.regex_str = self.regex_str.encode(encoding)
+        pattern.flags = self.flags & ~re.UNICODE
+        pattern.is_compiled = False
+        return pattern
+
+
+def any_prefilter(patterns):
+    '''prefilter of a pattern that matches when one of patterns matches'''
+    literals = []
+    for pattern in patterns:
+        prefilter = pattern.prefilter()
+        if prefilter is None:
+            return None
+        literals.extend(prefilter)
+    return literals
+
+def all_prefilter(patterns):
+    '''prefilter of a pattern that matches only when all patterns match
+
+    any one of them will do, the one with the fewest and longest literals
+    is taken
+    '''
+    best = None
+    for pattern in patterns:
+        prefilter = pattern.prefilter()
+        if prefilter is None:
+            continue
+        if best is None or (len(prefilter), -min(map(len, prefilter))) < \
+                           (len(best), -min(map(len, best))):
+            best = prefilter
+    return best
+
+def passes(prefilter, line):
+    for literal in prefilter:
+        if literal in line:
+            return True
+    return False
 
 
 class UnaryPattern(Pattern):
@@ -99,6 +263,9 @@ class UnaryPattern(Pattern):
     def match(self, line):
         raise NotImplementedError
 
+    def stateless(self):
+        return self.first.stateless()
+
 
 class BinaryPattern(Pattern):
     '''Base class for any binary operator
@@ -110,6 +277,9 @@ class BinaryPattern(Pattern):
     def match(self, line):
         raise NotImplementedError
 
+    def stateless(self):
+        return self.first.stateless() and self.second.stateless()
+
 
 class TrinaryPattern(Pattern):
     '''Base class for any trinary operator
@@ -119,10 +289,16 @@ class TrinaryPattern(Pattern):
         self.second = second
         self.third = third
 
+    def stateless(self):
+        return self.first.stateless() and self.second.stateless() and \
+               self.third.stateless()
+
 
 class AndPattern(BinaryPattern):
     '''and operator analagous to the python 'and' operator
     '''
+    _prefilter = None
+
     def match(self, line):
         '''operates the same as 'and' in python namely:
 
@@ -131,8 +307,17 @@ class AndPattern(BinaryPattern):
 
         evaluates lazy, so if the first match fails, the second match is never evaluated
         '''
+        if self._prefilter is None:
+            self._prefilter = self.prefilter() or ()
+        if self._prefilter and not passes(self._prefilter, line):
+            return None
         return self.first.match(line) and self.second.match(line)
 
+    def prefilter(self):
+        if not self.stateless():
+            return None
+        return all_prefilter((self.first, self.second))
+
 
 class OrPattern(BinaryPattern):
     '''or operator analagous to the python 'or' operator
@@ -147,6 +332,11 @@ class OrPattern(BinaryPattern):
         '''
         return self.first.match(line) or self.second.match(line)
 
+    def prefilter(self):
+        if not self.stateless():
+            return None
+        return any_prefilter((self.first, self.second))
+
 
 class RangePattern(BinaryPattern):
     '''matches against two patterns that define a range, as in Gnu Awk
@@ -174,6 +364,9 @@ class RangePattern(BinaryPattern):
                 return match
             return True
 
+    def stateless(self):
+        return False
+
 
 class NotPattern(UnaryPattern):
     '''analagous to python 'not' operator
@@ -194,18 +387,443 @@ class IfThenPattern(TrinaryPattern):
         else:
             return self.third.match(line)
 
+    def prefilter(self):
+        if not self.stateless():
+            return None
+        return any_prefilter((self.second, self.third))
+
+
+class Block(object):
+    '''the lines of one keyed range, from the line that opened it to the one
+    that closed it'''
+    __slots__ = ('key', 'lines', 'opened')
+
+    def __init__(self, key, line, opened):
+        self.key = key
+        self.lines = [line]
+        self.opened = opened
+
+    @property
+    def text(self):
+        return ''.join(self.lines)
+
+
+class KeyedRangePattern(TrinaryPattern):
+    '''many ranges open at once, one per key, eg. from "Starting job X" to
+    "Finished job X" for every job X
+
+    first opens the range of the key it finds and second closes it; third
+    picks the lines in between that belong to an open range.  key is the
+    regex group (name or number) holding the key, or a function of the
+    match.  the line that closes a range matches with the Block of that
+    range; no other line matches.  a key opened again starts over.
+
+    at most max_open ranges are kept, the oldest is dropped past that; a
+    range that has collected max_lines lines is dropped, and with a timeout
+    a range still open timeout lines of input (not seconds) after it opened
+    is dropped too.  dropped blocks go to on_drop when given.  memory is
+    bounded by max_open times max_lines lines; give max_lines=None to lift
+    that cap, with a timeout to bound it instead.
+    '''
+    def __init__(self, first, second, third=None, key=1, max_open=1000,
+                 timeout=None, on_drop=None, max_lines=10000):
+        TrinaryPattern.__init__(self, first, second, third or FalsePattern())
+        self.key = key
+        self.max_open = max_open
+        self.max_lines = max_lines
+        self.timeout = timeout
+        self.on_drop = on_drop
+        self.open = OrderedDict()
+        self.lines = 0
+        self.dropped = 0
+
+    def key_of(self, match):
+        if callable(self.key):
+            return self.key(match)
+        return match.group(self.key)
+
+    def drop(self, block):
+        self.dropped += 1
+        if self.on_drop is not None:
+            self.on_drop(block)
+
+    def expire(self):
+        oldest = self.lines - self.timeout
+        open_ranges = self.open
+        while open_ranges:
+            key = next(iter(open_ranges))
+            if open_ranges[key].opened >= oldest:
+                return
+            self.drop(open_ranges.pop(key))
+
+    def match(self, line):
+        self.lines += 1
+        open_ranges = self.open
+        if self.timeout is not None and open_ranges:
+            self.expire()
+        match = self.first.match(line)
+        if match:
+            key = self.key_of(match)
+            if key in open_ranges:
+                del open_ranges[key]
+            elif len(open_ranges) >= self.max_open:
+                self.drop(open_ranges.popitem(last=False)[1])
+            open_ranges[key] = Block(key, line, self.lines)
+            return None
+        if not open_ranges:
+            return None
+        match = self.second.match(line)
+        if match:
+            block = open_ranges.pop(self.key_of(match), None)
+            if block is not None:
+                block.lines.append(line)
+            return block
+        match = self.third.match(line)
+        if match:
+            key = self.key_of(match)
+            block = open_ranges.get(key)
+            if block is not None:
+                block.lines.append(line)
+                if self.max_lines is not None and \
+                   len(block.lines) >= self.max_lines:
+                    self.drop(open_ranges.pop(key))
+        return None
+
+    def stateless(self):
+        return False
+
 
 class OneOfPattern(Pattern):
     def __init__(self, *patterns):
         self.patterns = patterns
 
+    _prefilter = None
+
+    def prefilter(self):
+        if not self.stateless():
+            return None
+        return any_prefilter(self.patterns)
+
     def match(self, line):
+        if self._prefilter is None:
+            self._prefilter = self.prefilter() or ()
+        if self._prefilter and not passes(self._prefilter, line):
+            return None
         for pattern in self.patterns:
             match = pattern.match(line)
             if match:
                 return match
         return None
 
+    def stateless(self):
+        for pattern in self.patterns:
+            if not pattern.stateless():
+                return False
+        return True
+
+
+class AllOfPattern(Pattern):
+    '''a flattened chain of AndPatterns
+
+    matches like AndPattern(p1, AndPattern(p2, ...)): it returns the first
+    failure, or the match of the last pattern when they all match.  order
+    is the order the patterns are evaluated in, which the optimizer may
+    change for stateless patterns without changing what is returned.
+    '''
+    def __init__(self, patterns, order=None):
+        self.patterns = patterns
+        if order is None:
+            order = range(len(patterns))
+        self.order = order
+        self.evaluated = [patterns[i] for i in order]
+        self.last = len(patterns) - 1
+        self.in_order = list(order) == range(len(patterns))
+
+    def match(self, line):
+        if self.in_order:
+            for pattern in self.patterns:
+                match = pattern.match(line)
+                if not match:
+                    return match
+            return match
+        result = None
+        last = self.last
+        for i, pattern in zip(self.order, self.evaluated):
+            match = pattern.match(line)
+            if not match:
+                return match
+            if i == last:
+                result = match
+        return result
+
+    def prefilter(self):
+        if not self.stateless():
+            return None
+        return all_prefilter(self.patterns)
+
+    def stateless(self):
+        for pattern in self.patterns:
+            if not pattern.stateless():
+                return False
+        return True
+
+
+class AlternationPattern(Pattern):
+    '''a OneOfPattern over RegexPatterns that share their flags, checked
+    with one combined regex
+
+    a line the combined regex misses matches none of the patterns.  when
+    every pattern is anchored at the start of the line, the branch that
+    matched is the first pattern that matches at all, so only that one is
+    run again to get its own MatchObject; otherwise they are tried in order
+    like OneOfPattern does.
+    '''
+    def __init__(self, patterns, anchored=False):
+        self.patterns = patterns
+        self.anchored = anchored
+        sources = [screen_source(pattern.regex_str) for pattern in patterns]
+        self.regex = re.compile('|'.join('(%s)' % source for source in sources),
+                                patterns[0].flags)
+
+    def match(self, line):
+        found = self.regex.search(line)
+        if found is None:
+            return None
+        if self.anchored:
+            return self.patterns[found.lastindex - 1].match(line)
+        for pattern in self.patterns:
+            match = pattern.match(line)
+            if match:
+                return match
+        return None
+
+    def prefilter(self):
+        return any_prefilter(self.patterns)
+
+
+def subpatterns(pattern):
+    '''the patterns a composite pattern is built from'''
+    if isinstance(pattern, (OneOfPattern, AllOfPattern, AlternationPattern)):
+        return list(pattern.patterns)
+    if isinstance(pattern, TrinaryPattern):
+        return [pattern.first, pattern.second, pattern.third]
+    if isinstance(pattern, BinaryPattern):
+        return [pattern.first, pattern.second]
+    if isinstance(pattern, UnaryPattern):
+        return [pattern.first]
+    return []
+
+def encode_text(text, encoding='utf-8'):
+    if isinstance(text, unicode):
+        return text.encode(encoding)
+    return text
+
+def encode_pattern(pattern, encoding='utf-8'):
+    '''a copy of a pattern tree for lines of bytes in encoding, see
+    RegexPattern.encoded; parts without regexes or text are kept as they are
+    '''
+    if isinstance(pattern, RegexPattern):
+        return pattern.encoded(encoding)
+    if isinstance(pattern, FieldComparePattern):
+        if not isinstance(pattern.value, unicode):
+            return pattern
+        new = copy(pattern)
+        new.value = pattern.value.encode(encoding)
+        return new
+    kids = subpatterns(pattern)
+    new_kids = [encode_pattern(kid, encoding) for kid in kids]
+    if new_kids == kids:
+        return pattern
+    if isinstance(pattern, AlternationPattern):
+        return AlternationPattern(new_kids, pattern.anchored)
+    if isinstance(pattern, AllOfPattern):
+        return AllOfPattern(new_kids, pattern.order)
+    new = copy(pattern)
+    if isinstance(pattern, OneOfPattern):
+        new.patterns = tuple(new_kids)
+    elif isinstance(pattern, TrinaryPattern):
+        new.first, new.second, new.third = new_kids
+    elif isinstance(pattern, BinaryPattern):
+        new.first, new.second = new_kids
+    else:
+        new.first, = new_kids
+    if '_prefilter' in new.__dict__:
+        del new._prefilter
+    return new
+
+def uses_fields(pattern):
+    '''whether anything in the pattern tree looks at fields'''
+    if isinstance(pattern, (FieldPattern, FieldComparePattern)):
+        return True
+    for child in subpatterns(pattern):
+        if uses_fields(child):
+            return True
+    return False
+
+
+def split_fields(text, fs=' '):
+    '''splits a record into fields like Gnu Awk does
+
+    a single space splits on runs of whitespace, ignoring it at both ends,
+    any other single character splits on that character, and anything
+    longer is a regex.  a trailing newline is not part of the last field.
+    '''
+    if text.endswith('\n'):
+        text = text[:-1]
+    if fs == ' ':
+        return text.split()
+    if not text:
+        return []
+    if len(fs) == 1:
+        return text.split(fs)
+    return re.split(fs, text)
+
+
+class RecordFields(object):
+    '''the awk fields of a record, split the first time they are asked for
+
+    $0 is field(0), $1..$NF are field(1)..field(nf)
+    '''
+    @property
+    def fields(self):
+        try:
+            return self._fields
+        except AttributeError:
+            self._fields = split_fields(self, self.fs)
+            return self._fields
+
+    @property
+    def nf(self):
+        return len(self.fields)
+
+    def field(self, n):
+        if n == 0:
+            return self.rstrip('\n')
+        fields = self.fields
+        if 0 < n <= len(fields):
+            return fields[n - 1]
+        return ''
+
+
+class Record(RecordFields, str):
+    '''a str line that carries its own lazily split fields'''
+    def __new__(cls, text, fs=' '):
+        record = str.__new__(cls, text)
+        record.fs = fs
+        return record
+
+
+class UnicodeRecord(RecordFields, unicode):
+    def __new__(cls, text, fs=' '):
+        record = unicode.__new__(cls, text)
+        record.fs = fs
+        return record
+
+
+def make_record(line, fs=' '):
+    if isinstance(line, unicode):
+        return UnicodeRecord(line, fs)
+    return Record(line, fs)
+
+def field_of(line, n, fs=' '):
+    '''field n of a line, using the cached fields of a Record'''
+    if isinstance(line, RecordFields):
+        return line.field(n)
+    if n == 0:
+        return line.rstrip('\n')
+    fields = split_fields(line, fs)
+    if 0 < n <= len(fields):
+        return fields[n - 1]
+    return ''
+
+
+class RecordSplitter(object):
+    '''splits text fed to it in chunks into records on rs, like Gnu Awk
+
+    a single character rs splits on that character, an empty rs splits on
+    blank lines (paragraph mode) and anything longer is a regex.  records
+    do not include the separator.  feed() returns the records completed
+    by a chunk, close() the last one.
+    '''
+    def __init__(self, rs):
+        self.rs = rs
+        if rs == '':
+            self.splitter = re.compile(r'\n\n+').split
+        elif len(rs) == 1:
+            self.splitter = lambda text: text.split(rs)
+        else:
+            self.splitter = re.compile(rs).split
+        self.carry = ''
+
+    def feed(self, chunk):
+        parts = self.splitter(self.carry + chunk)
+        self.carry = parts.pop()
+        if self.rs == '':
+            parts = [part.lstrip('\n') for part in parts]
+            parts = [part for part in parts if part]
+        return parts
+
+    def close(self):
+        carry = self.carry
+        self.carry = ''
+        if self.rs == '':
+            carry = carry.strip('\n')
+        if carry:
+            return [carry]
+        return []
+
+
+def split_records(chunks, rs):
+    '''splits a stream of text chunks into records on rs, see RecordSplitter
+    '''
+    splitter = RecordSplitter(rs)
+    for chunk in chunks:
+        for record in splitter.feed(chunk):
+            yield record
+    for record in splitter.close():
+        yield record
+
+
+class FieldPattern(UnaryPattern):
+    '''matches a pattern against one field of the line instead of all of it
+
+    eg. FieldPattern(9, RegexPattern(r'^5\d\d$')) for $9 ~ /^5[0-9][0-9]$/
+    '''
+    def __init__(self, n, first, fs=' '):
+        self.n = n
+        self.first = first
+        self.fs = fs
+
+    def match(self, line):
+        return self.first.match(field_of(line, self.n, self.fs))
+
+
+class FieldComparePattern(Pattern):
+    '''compares one field with a value, eg. $3 > 500
+
+    compares numerically when value is a number and the field looks like
+    one, as strings otherwise
+    '''
+    operators = {'==': lambda a, b: a == b, '!=': lambda a, b: a != b,
+                 '<': lambda a, b: a < b, '<=': lambda a, b: a <= b,
+                 '>': lambda a, b: a > b, '>=': lambda a, b: a >= b}
+
+    def __init__(self, n, op, value, fs=' '):
+        self.n = n
+        self.op = op
+        self.compare = self.operators[op]
+        self.value = value
+        self.fs = fs
+
+    def match(self, line):
+        field = field_of(line, self.n, self.fs)
+        if isinstance(self.value, (int, long, float)):
+            try:
+                return self.compare(float(field), self.value)
+            except ValueError:
+                return self.compare(field, str(self.value))
+        return self.compare(field, self.value)
+
 
 def handler(awk, match, line):
     '''function signature'''
@@ -221,7 +839,16 @@ class BaseHandler(object):
         yield
 
 
+def handler_stateless(handler):
+    '''handlers are taken to keep state between lines unless they say
+    otherwise with a true stateless attribute
+    '''
+    return getattr(handler, 'stateless', False) is True
+
+
 class PrintHandler(object):
+    stateless = True
+
     def __call__(self, awk, match, line):
         yield line
 
@@ -239,6 +866,11 @@ class Action(object):
         if match:
             return self.handler(awk, match, line)
 
+    def stateless(self):
+        '''whether the action can run on any line without the lines before it
+        '''
+        return self.pattern.stateless() and handler_stateless(self.handler)
+
     def __call__(self, awk, line):
         '''convenience function
         '''
@@ -259,6 +891,10 @@ class EitherOrHandler(BaseHandler):
         self.left = left
         self.right = right
 
+    @property
+    def stateless(self):
+        return handler_stateless(self.left) and handler_stateless(self.right)
+
     def __call__(self, awk, match, line):
         if match.right:
             return self.right(awk, match.value, line)
@@ -295,13 +931,24 @@ class ActionOrPrint(Action):
 BarPattern = RegexPattern(r'(?P<bar>bar)')
 def BarHandler(awk, match, line):
     yield 'quack!'
+BarHandler.stateless = True
 
 BarAction = ActionOrPrint(BarPattern, BarHandler)
 
 
+class BlockHandler(object):
+    '''prints the block a KeyedRangePattern matched as one record'''
+    stateless = True
+
+    def __call__(self, awk, match, line):
+        yield match.text
+
+
 class DoubleHandler(object):
     '''an example handler that doubles a line given
     '''
+    stateless = True
+
     def __call__(self, awk, match, line):
         yield line
         yield line
@@ -315,6 +962,8 @@ class IncrementHandler(object):
     '''an example handler that counts up each time it's called and yields 
     a line n times for the current count, including a prefixed line number
     '''
+    stateless = False
+
     def __init__(self):
         self.count = 0
 
@@ -326,40 +975,809 @@ class IncrementHandler(object):
 
 IncrementPrint = Action(handler=IncrementHandler())
 
+
+def screen_source(regex_str):
+    """rewrites a regex so it can be one branch of a larger alternation
+
+    every group becomes non-capturing, so names cannot clash and the group
+    count stays low.  returns None for regexes that cannot be rewritten this
+    way: backreferences, conditionals and inline flags, which in this
+    version of python apply to the whole regex.
+    """
+    out = []
+    i = 0
+    in_class = False
+    n = len(regex_str)
+    while i < n:
+        c = regex_str[i]
+        if c == '\\':
+            if i + 1 < n and regex_str[i + 1] in '0123456789' and not in_class:
+                return None
+            out.append(regex_str[i:i + 2])
+            i += 2
+            continue
+        if in_class:
+            if c == ']':
+                in_class = False
+            out.append(c)
+        elif c == '[':
+            in_class = True
+            out.append(c)
+            if regex_str[i + 1:i + 2] == '^':
+                out.append('^')
+                i += 1
+            if regex_str[i + 1:i + 2] == ']':
+                out.append(']')
+                i += 1
+        elif c == '(':
+            if regex_str.startswith('(?P<', i):
+                end = regex_str.find('>', i)
+                if end < 0:
+                    return None
+                out.append('(?:')
+                i = end + 1
+                continue
+            elif regex_str.startswith('(?', i):
+                if regex_str[i + 2:i + 3] not in (':', '=', '!', '<', '#'):
+                    return None
+                out.append(c)
+            else:
+                out.append('(?:')
+        else:
+            out.append(c)
+        i += 1
+    return ''.join(out)
+
+
+def screenable(action):
+    """the RegexPattern an action can be screened on, or None
+
+    plain Actions on a RegexPattern and ActionOrPrints wrapping one qualify,
+    as long as the pattern does not override RegexPattern.match and has no
+    literal test or prefilter of its own
+    """
+    if action.match.im_func is not Action.match.im_func:
+        return None
+    pattern = action.pattern
+    if isinstance(pattern, MatchOrEveryLinePattern):
+        if not isinstance(action.handler, MatchOrPrintHandler):
+            return None
+        pattern = pattern.first
+    if not isinstance(pattern, RegexPattern) or \
+       type(pattern).match.im_func is not RegexPattern.match.im_func:
+        return None
+    if pattern.prefilter() or pattern.test is not None:
+        return None
+    return pattern
+
+
+class MultiRegexAction(Action):
+    """a run of consecutive regex actions scanned with one combined regex
+
+    every regex is a capturing branch of the alternation, so a search tells
+    which action matched first and where.  a line it misses matches none of
+    the actions, in one search instead of one per action.  on a hit at some
+    position, the leftmost match of that action starts there, so its
+    MatchObject comes from an anchored match; none of the others can match
+    any earlier, so the scan goes on from there with the alternation of the
+    ones still undecided, and so on for every hit.  a line is scanned about
+    once per action it matches, instead of once per action.  those
+    alternations are compiled as they are needed, at most max_alternations
+    of them; past that the undecided regexes are searched one by one.  the
+    matching actions then run in order, so several actions still fire for
+    the same line like in Gnu Awk.
+
+    only regexes without a literal test or prefilter are merged (see
+    screenable): those reject most lines in C already, faster than the
+    combined regex, which re tries branch by branch at every position.
+    """
+    max_alternations = 256
+
+    def __init__(self, actions, sources, flags=0):
+        self.actions = actions
+        self.patterns = [screenable(action) for action in actions]
+        self.sources = sources
+        self.flags = flags
+        self.alternations = {}
+        self.regex = self.alternation(frozenset())[0]
+        self.pattern = EveryLinePattern
+        self.handler = None
+
+    def alternation(self, excluded):
+        """(the alternation of the regexes not in excluded, their indices),
+        or None when too many have been compiled"""
+        found = self.alternations.get(excluded)
+        if found is None:
+            if len(self.alternations) >= self.max_alternations:
+                return None
+            indices = [i for i in range(len(self.sources)) if i not in excluded]
+            regex = re.compile('|'.join(['(%s)' % self.sources[i]
+                                         for i in indices]), self.flags)
+            found = self.alternations[excluded] = (regex, indices)
+        return found
+
+    def matches(self, line, found):
+        """the MatchObject of every action, or None, given the search of the
+        combined regex that found a hit"""
+        patterns = self.patterns
+        result = [None] * len(patterns)
+        indices = range(len(patterns))
+        excluded = frozenset()
+        while True:
+            hit = indices[found.lastindex - 1]
+            pos = found.start()
+            result[hit] = patterns[hit].regex.match(line, pos)
+            excluded = excluded | frozenset([hit])
+            if len(excluded) == len(patterns):
+                return result
+            alternation = self.alternation(excluded)
+            if alternation is None:
+                break
+            regex, indices = alternation
+            found = regex.search(line, pos)
+            if found is None:
+                return result
+        for i, pattern in enumerate(patterns):
+            if i not in excluded:
+                result[i] = pattern.regex.search(line, pos)
+        return result
+
+    def match(self, awk, line):
+        found = self.regex.search(line)
+        if found is None:
+            return self.miss(awk, line)
+        return self.run(awk, line, self.matches(line, found))
+
+    def miss(self, awk, line):
+        either = [action for action in self.actions
+                  if isinstance(action.pattern, MatchOrEveryLinePattern)]
+        if either:
+            return self.run_either(awk, line, either)
+
+    def run_either(self, awk, line, actions):
+        for action in actions:
+            result = action.handler(awk, Either(True, right=False), line)
+            if result:
+                for out in result:
+                    yield out
+
+    def run(self, awk, line, matches):
+        for action, match in zip(self.actions, matches):
+            if isinstance(action.pattern, MatchOrEveryLinePattern):
+                result = action.handler(awk, Either(match or True,
+                                                    right=bool(match)), line)
+            elif match:
+                result = action.handler(awk, match, line)
+            else:
+                continue
+            if result:
+                for out in result:
+                    yield out
+
+    def stateless(self):
+        for action in self.actions:
+            if not action.stateless():
+                return False
+        return True
+
+
+# re allows at most 100 groups, one per merged regex
+MAX_MERGED = 99
+
+def pays_off(action, sample):
+    """whether a MultiRegexAction decides the lines of sample faster than
+    its members' own regexes do"""
+    regex = action.regex
+    matches = action.matches
+    start = time()
+    for line in sample:
+        found = regex.search(line)
+        if found is not None:
+            matches(line, found)
+    merged = time() - start
+    searches = [pattern.regex.search for pattern in action.patterns]
+    start = time()
+    for line in sample:
+        for search in searches:
+            search(line)
+    return merged < time() - start
+
+def merge_regex_actions(actions, sample=None):
+    """replaces each run of consecutive screenable actions whose regexes
+    share the same flags with a MultiRegexAction
+
+    with a sample of lines, a run is only merged when that pays off on them
+    """
+    merged = []
+    run = []
+    def close_run():
+        if len(run) > 1:
+            sources = [source for action, source, flags in run]
+            try:
+                action = MultiRegexAction([action for action, s, f in run],
+                                          sources, run[0][2])
+            except (re.error, AssertionError):
+                action = None
+            if action is not None and sample is not None and \
+               not pays_off(action, sample):
+                action = None
+            if action is not None:
+                merged.append(action)
+                del run[:]
+                return
+        merged.extend(action for action, source, flags in run)
+        del run[:]
+    for action in actions:
+        pattern = screenable(action)
+        source = pattern is not None and screen_source(pattern.regex_str) or None
+        if source is None:
+            close_run()
+            merged.append(action)
+            continue
+        if run and (run[0][2] != pattern.flags or len(run) >= MAX_MERGED):
+            close_run()
+        run.append((action, source, pattern.flags))
+    close_run()
+    return merged
+
+
+class Aggregates(object):
+    '''named aggregate tables shared by the handlers of an AwkInstance
+
+    the awk idiom count[$3]++ is awk.agg.count('count', field), sum[$1] += $2
+    is awk.agg.add('sum', key, value).  every name holds one table of
+    key -> value; a table is either a count, a sum, a min or a max.  the
+    tables of two instances that ran over different parts of the input can
+    be merged, which is how the parallel runner combines its shards.
+    '''
+    KINDS = ('count', 'sum', 'min', 'max')
+
+    def __init__(self):
+        self.tables = {}
+        self.kinds = {}
+
+    def table(self, name, kind):
+        try:
+            table = self.tables[name]
+        except KeyError:
+            table = self.tables[name] = {}
+            self.kinds[name] = kind
+        else:
+            if self.kinds[name] != kind:
+                raise ValueError('aggregate %s is a %s, not a %s' %
+                                 (name, self.kinds[name], kind))
+        return table
+
+    def count(self, name, key, n=1):
+        table = self.table(name, 'count')
+        table[key] = table.get(key, 0) + n
+
+    def add(self, name, key, value):
+        table = self.table(name, 'sum')
+        table[key] = table.get(key, 0) + value
+
+    def minimum(self, name, key, value):
+        table = self.table(name, 'min')
+        if key not in table or value < table[key]:
+            table[key] = value
+
+    def maximum(self, name, key, value):
+        table = self.table(name, 'max')
+        if key not in table or value > table[key]:
+            table[key] = value
+
+    def get(self, name, key, default=None):
+        return self.tables.get(name, {}).get(key, default)
+
+    def __getitem__(self, name):
+        return self.tables[name]
+
+    def __contains__(self, name):
+        return name in self.tables
+
+    def items(self, name):
+        '''(key, value) pairs of a table, sorted by key'''
+        return sorted(self.tables.get(name, {}).iteritems())
+
+    def top(self, name, k):
+        '''the k (key, value) pairs of a table with the highest values,
+        ties in key order'''
+        return nsmallest(k, self.tables.get(name, {}).iteritems(),
+                         key=lambda (key, value): (-value, key))
+
+    def merge(self, other):
+        '''folds the tables of other into these'''
+        for name, theirs in other.tables.iteritems():
+            kind = other.kinds[name]
+            ours = self.table(name, kind)
+            if kind in ('count', 'sum'):
+                for key, value in theirs.iteritems():
+                    ours[key] = ours.get(key, 0) + value
+            else:
+                better = kind == 'min' and min or max
+                for key, value in theirs.iteritems():
+                    if key in ours:
+                        ours[key] = better(ours[key], value)
+                    else:
+                        ours[key] = value
+
+    def clear(self):
+        self.tables.clear()
+        self.kinds.clear()
+
+
+def key_function(key):
+    '''turns key into a function of (awk, match, line)
+
+    key can be a field number, a regex group name, or a function of
+    (awk, match, line) already
+    '''
+    if callable(key):
+        return key
+    if isinstance(key, (int, long)):
+        return lambda awk, match, line: field_of(line, key, awk.fs)
+    return lambda awk, match, line: match.group(key)
+
+def number(value):
+    '''value as an int or a float, 0 when it is not a number and None when
+    it is missing, eg. an optional group that did not take part'''
+    if value is None or isinstance(value, (int, long, float)):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return 0
+
+
+class AggregateHandler(object):
+    '''updates the aggregate name for every line it handles
+
+    kind is one of Aggregates.KINDS; key picks the key and value the
+    number added or compared (both as in key_function).  a count goes up
+    by one when value is None; a line whose value is missing, eg. from an
+    optional group, is skipped.  it prints nothing, so several shards can
+    run it and merge the result.
+    '''
+    stateless = True
+
+    def __init__(self, name, kind, key, value=None):
+        if kind not in Aggregates.KINDS:
+            raise ValueError('unknown aggregate kind %s' % kind)
+        if value is None and kind != 'count':
+            raise ValueError('a %s aggregate needs a value' % kind)
+        self.name = name
+        self.kind = kind
+        self.key = key_function(key)
+        if value is None:
+            self.value = lambda awk, match, line: 1
+        else:
+            value_of = key_function(value)
+            self.value = lambda awk, match, line: number(value_of(awk, match, line))
+        self.update = {'count': Aggregates.count, 'sum': Aggregates.add,
+                       'min': Aggregates.minimum, 'max': Aggregates.maximum}[kind]
+
+    def __call__(self, awk, match, line):
+        value = self.value(awk, match, line)
+        if value is not None:
+            self.update(awk.agg, self.name, self.key(awk, match, line), value)
+        return None
+
+def CountAction(pattern, name, key):
+    '''the equivalent of pattern { name[key]++ }'''
+    return Action(pattern, AggregateHandler(name, 'count', key))
+
+def SumAction(pattern, name, key, value):
+    '''the equivalent of pattern { name[key] += value }'''
+    return Action(pattern, AggregateHandler(name, 'sum', key, value))
+
+
+class ReportHandler(object):
+    '''prints an aggregate, for an End action
+
+    one line per key, sorted by key, or only the k highest values when k is
+    given; line_format gets the key and the value
+    '''
+    def __init__(self, name, k=None, line_format='%s %s\n'):
+        self.name = name
+        self.k = k
+        self.line_format = line_format
+
+    def __call__(self, awk, match, line):
+        if self.k is None:
+            pairs = awk.agg.items(self.name)
+        else:
+            pairs = awk.agg.top(self.name, self.k)
+        for key, value in pairs:
+            yield self.line_format % (key, value)
+
+def ReportAction(name, k=None, line_format='%s %s\n'):
+    return Action(End, ReportHandler(name, k, line_format))
+
+
+def memoizable(action):
+    '''the pattern of action can be evaluated once for equal lines: it is
+    stateless and the action matches the plain way'''
+    return type(action).match.im_func is Action.match.im_func and \
+           action.pattern.stateless()
+
+
+class MatchMemo(object):
+    '''a bounded LRU cache of the pattern matches of lines
+
+    for every line seen (or its key, when key is given) it keeps the
+    match each memoizable action's pattern returned, so an equal line
+    later skips all the pattern evaluation.  key normalizes a line, eg.
+    into a template with the numbers masked out; it must only erase what
+    none of the patterns look at, as the handlers of a line get the match
+    of the first line with that key.
+
+    after every check lookups the hit rate is checked, and a memo that
+    hits less than min_hit_rate turns itself off.
+    '''
+    def __init__(self, size=10000, key=None, min_hit_rate=0.2, check=10000):
+        self.size = size
+        self.key = key
+        self.min_hit_rate = min_hit_rate
+        self.check = check
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.enabled = True
+
+    def lookup(self, line, patterns):
+        '''the matches of patterns for line'''
+        if self.key is None:
+            key = line
+        else:
+            key = self.key(line)
+        entries = self.entries
+        matches = entries.pop(key, None)
+        if matches is None:
+            self.misses += 1
+            matches = tuple([pattern.match(line) for pattern in patterns])
+            if len(entries) >= self.size:
+                entries.popitem(last=False)
+        else:
+            self.hits += 1
+        entries[key] = matches
+        lookups = self.hits + self.misses
+        if lookups % self.check == 0 and self.hit_rate() < self.min_hit_rate:
+            self.enabled = False
+            entries.clear()
+        return matches
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return lookups and float(self.hits) / lookups or 0.0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hit_rate(), 'entries': len(self.entries),
+                'enabled': self.enabled}
+
+
+def describe_pattern(pattern):
+    '''a short readable form of a pattern tree'''
+    if pattern is EveryLinePattern:
+        return 'every line'
+    if isinstance(pattern, RegexPattern):
+        return '/%s/' % pattern.regex_str
+    kids = subpatterns(pattern)
+    if not kids:
+        return type(pattern).__name__
+    return '%s(%s)' % (type(pattern).__name__,
+                       ', '.join([describe_pattern(kid) for kid in kids]))
+
+def describe_action(action):
+    if isinstance(action, MultiRegexAction):
+        return 'merged [%s]' % '; '.join([describe_action(member)
+                                          for member in action.actions])
+    handler = getattr(action, 'handler', None)
+    name = getattr(handler, '__name__', type(handler).__name__)
+    return '%s -> %s' % (describe_pattern(action.pattern), name)
+
+
+class ActionProfile(object):
+    '''what one action cost
+
+    the time of an action that overrides match, eg. MultiRegexAction,
+    all counts as pattern time
+    '''
+    __slots__ = ('action', 'evaluations', 'matches', 'handler_calls',
+                 'outputs', 'pattern_time', 'handler_time')
+
+    def __init__(self, action):
+        self.action = action
+        self.evaluations = 0
+        self.matches = 0
+        self.handler_calls = 0
+        self.outputs = 0
+        self.pattern_time = 0.0
+        self.handler_time = 0.0
+
+    @property
+    def total_time(self):
+        return self.pattern_time + self.handler_time
+
+
+class Profile(object):
+    '''per action counts and times of the per line actions of an instance'''
+    def __init__(self, actions):
+        self.actions = [ActionProfile(action) for action in actions]
+        self.lines = 0
+
+    def report(self):
+        '''a table of the actions, most expensive first'''
+        rows = sorted(self.actions, key=lambda p: -p.total_time)
+        total = sum([p.total_time for p in rows]) or 1.0
+        out = ['%d lines' % self.lines,
+               '%8s %8s %8s %8s %9s %9s %6s  %s' % (
+                   'evals', 'matches', 'handled', 'output', 'pattern',
+                   'handler', '%', 'action')]
+        for p in rows:
+            out.append('%8d %8d %8d %8d %8.3fs %8.3fs %5.1f%%  %s' % (
+                    p.evaluations, p.matches, p.handler_calls, p.outputs,
+                    p.pattern_time, p.handler_time,
+                    100.0 * p.total_time / total, describe_action(p.action)))
+        return '\n'.join(out)
+
+
 class AwkInstance(object):
     def __init__(self, begin, actions, end):
         self.fs = ' '
         self.nr = 0
         self.rs = '\n'
+        self.use_fields = False
+        self.encoding = None
+        self.agg = Aggregates()
+        self.memo = None
+        self.profile = None
         self.begin = begin
         self.actions = actions
         self.end = end
 
+    def records(self, generator):
+        '''the records of the input
+
+        with the default rs the lines are taken as they are, newline
+        included; any other rs splits the input (treated as one stream)
+        into records without the separator.  when use_fields is set the
+        records are Records, which split their fields on fs the first
+        time a pattern or handler asks for them.
+        '''
+        if self.rs != '\n':
+            generator = split_records(generator, self.rs)
+        if self.use_fields:
+            fs = self.fs
+            generator = imap(lambda line: make_record(line, fs), generator)
+        return generator
+
     def process(self, generator):
         '''for some iterable, run all the actions given
         '''
-        for action in self.begin:
+        for out in self.run_once(self.begin):
+            yield out
+        for out in self.line_runner()(self.records(generator)):
+            yield out
+        for out in self.run_once(self.end):
+            yield out
+
+    def run_once(self, actions):
+        '''runs BEGIN or END actions'''
+        for action in actions:
             result = action.match(self, None)
             if result:
-                for line in result:
-                    yield line
-        for line in generator:
+                for out in result:
+                    yield out
+
+    def line_runner(self):
+        '''the function that runs the per line actions over records'''
+        if self.profile is not None:
+            return self.run_lines_profiled
+        if self.memo is not None and self.memo.enabled:
+            return self.run_lines_memo
+        return self.run_lines
+
+    def run_lines(self, lines):
+        for line in lines:
             for action in self.actions:
                 result = action.match(self, line)
                 if result:
-                    for line in result:
-                        yield line
+                    for out in result:
+                        yield out
             self.nr += 1
-        for action in self.end:
-            result = action.match(self, None)
-            if result:
-                for line in result:
-                    yield line
+
+    def run_lines_memo(self, lines):
+        '''run_lines, with the matches of the memoizable actions taken
+        from self.memo; goes on without it when the memo turns itself off
+        '''
+        memo = self.memo
+        actions = self.actions
+        cached = [memoizable(action) for action in actions]
+        patterns = [action.pattern for action in actions if memoizable(action)]
+        lines = iter(lines)
+        for line in lines:
+            matches = iter(memo.lookup(line, patterns))
+            for action, is_cached in zip(actions, cached):
+                if is_cached:
+                    match = matches.next()
+                    result = match and action.handler(self, match, line)
+                else:
+                    result = action.match(self, line)
+                if result:
+                    for out in result:
+                        yield out
+            self.nr += 1
+            if not memo.enabled:
+                for out in self.run_lines(lines):
+                    yield out
+                return
+
+    def memoize(self, size=10000, key=None, min_hit_rate=0.2, check=10000):
+        '''caches the pattern matches of repeated lines, see MatchMemo;
+        returns the memo, for its stats()'''
+        self.memo = MatchMemo(size, key, min_hit_rate, check)
+        return self.memo
+
+    def run_lines_profiled(self, lines):
+        '''run_lines, timing and counting every action in self.profile'''
+        profile = self.profile
+        entries = zip(self.actions, profile.actions)
+        for line in lines:
+            for action, p in entries:
+                p.evaluations += 1
+                if type(action).match.im_func is not Action.match.im_func:
+                    start = time()
+                    result = action.match(self, line)
+                    result = result and list(result)
+                    p.pattern_time += time() - start
+                    if result:
+                        p.matches += 1
+                        p.outputs += len(result)
+                        for out in result:
+                            yield out
+                    continue
+                start = time()
+                match = action.pattern.match(line)
+                matched = time()
+                p.pattern_time += matched - start
+                if not match:
+                    continue
+                p.matches += 1
+                p.handler_calls += 1
+                result = action.handler(self, match, line)
+                result = result and list(result)
+                p.handler_time += time() - matched
+                if result:
+                    p.outputs += len(result)
+                    for out in result:
+                        yield out
+            self.nr += 1
+            profile.lines += 1
+
+    def enable_profiling(self):
+        '''counts and times every per line action from now on; returns the
+        Profile, whose report() shows which actions cost the most'''
+        self.profile = Profile(self.actions)
+        return self.profile
+
+    def feeder(self):
+        '''an AwkFeed, to push input into this instance instead'''
+        return AwkFeed(self)
 
     def __call__(self, generator):
         return self.process(generator)
 
 
+class AwkFeed(object):
+    '''pushes input through an AwkInstance in batches
+
+    process() pulls its input from an iterable; a feed is for input that
+    arrives on its own time, from a socket or a tailed file.  every
+    feed(batch) runs the per line actions over a list of lines (or text
+    chunks, when rs is not a newline) and returns the output as a list;
+    BEGIN runs before the first batch and finish() runs END.  the output
+    is the same as process() over all the batches in one go.
+
+    feed fits the analyze hook of alispgm's IngestServer, which already
+    hands over its input in batches.
+    '''
+    def __init__(self, awk):
+        self.awk = awk
+        self.started = False
+        self.finished = False
+        self.splitter = None
+        if awk.rs != '\n':
+            self.splitter = RecordSplitter(awk.rs)
+
+    def start(self):
+        '''runs BEGIN, once'''
+        if self.started:
+            return []
+        self.started = True
+        return list(self.awk.run_once(self.awk.begin))
+
+    def run(self, records):
+        awk = self.awk
+        if awk.use_fields:
+            fs = awk.fs
+            records = [make_record(record, fs) for record in records]
+        return list(awk.line_runner()(records))
+
+    def feed(self, batch):
+        if self.finished:
+            raise ValueError('feed after finish')
+        output = self.start()
+        if self.splitter is not None:
+            records = []
+            for chunk in batch:
+                records.extend(self.splitter.feed(chunk))
+            batch = records
+        output.extend(self.run(batch))
+        return output
+
+    def finish(self):
+        '''runs what is left over and END, once'''
+        if self.finished:
+            return []
+        output = self.start()
+        self.finished = True
+        if self.splitter is not None:
+            output.extend(self.run(self.splitter.close()))
+        output.extend(self.awk.run_once(self.awk.end))
+        return output
+
+
+class TextHandler(object):
+    '''runs a handler that wants text in bytes mode
+
+    the line is decoded for the handler (with errors, so a broken line
+    does not stop the program) and unicode output is encoded back.  the
+    encoding defaults to the one of the instance.
+    '''
+    def __init__(self, handler, encoding=None, errors='replace'):
+        self.handler = handler
+        self.encoding = encoding
+        self.errors = errors
+
+    @property
+    def stateless(self):
+        return handler_stateless(self.handler)
+
+    def __call__(self, awk, match, line):
+        encoding = self.encoding or awk.encoding or 'utf-8'
+        text = line.decode(encoding, self.errors)
+        if isinstance(line, RecordFields):
+            text = make_record(text, line.fs.decode(encoding, self.errors))
+        result = self.handler(awk, match, text)
+        if result:
+            for out in result:
+                if isinstance(out, unicode):
+                    out = out.encode(encoding)
+                yield out
+
+
+class QueueHandler(object):
+    '''hands lines to another thread through a Queue.Queue, never blocking
+
+    a line that does not fit in a full queue is dropped and counted in
+    dropped.  it prints nothing itself.
+    '''
+    def __init__(self, queue):
+        self.queue = queue
+        self.dropped = 0
+
+    def __call__(self, awk, match, line):
+        try:
+            self.queue.put_nowait(line)
+        except Full:
+            self.dropped += 1
+        return None
+
+
 class AwkProgram(object):
     '''Class representing an instance of awk
 
@@ -370,8 +1788,22 @@ class AwkProgram(object):
         self.actions = list()
         self.begin = list()
         self.end = list()
+        self.fs = ' '
+        self.rs = '\n'
+        self.use_fields = False
+        self.encoding = None
+
+    def empty_copy(self):
+        '''a program without actions but with the same fs, rs, use_fields
+        and encoding
+        '''
+        program = AwkProgram()
+        program.fs = self.fs
+        program.rs = self.rs
+        program.use_fields = self.use_fields
+        program.encoding = self.encoding
+        return program
 
-    
     def add_pattern_w_handler(self, pattern, handler):
         '''given a simple pattern and handler, add it to the queue
         '''
@@ -390,12 +1822,75 @@ class AwkProgram(object):
             self.end.append(action)
         else:
             self.actions.append(action)
+            if uses_fields(action.pattern):
+                self.use_fields = True
+
+    def compile(self, sample=None):
+        '''returns a copy of the program where consecutive regex actions are
+        merged, so each line is scanned about once per action it matches
+        instead of once per action
+
+        whether that is faster depends on the regexes and the input, as re
+        tries the branches of the combined regex one by one; with a sample
+        of the input, only the merges that are faster on it are made.
+
+        see MultiRegexAction
+        '''
+        program = self.empty_copy()
+        program.begin = copy(self.begin)
+        program.actions = merge_regex_actions(self.actions, sample)
+        program.end = copy(self.end)
+        return program
+
+    def bytes_mode(self, encoding='utf-8'):
+        '''returns a copy of the program that works on lines of bytes
+
+        in Python 2 a str line is bytes already; what costs is unicode in
+        the program, which makes re and the literal prefilters decode every
+        line as ascii, and fail on lines that are not.  the copy has every
+        regex and compared value encoded (see encode_pattern), so the lines
+        are never decoded unless a TextHandler asks for text.  feed it str
+        lines, eg. from awk_io, not decoded ones.
+        '''
+        def encoded(action):
+            if isinstance(action, MultiRegexAction):
+                return merge_regex_actions([encoded(member)
+                                            for member in action.actions])
+            action = copy(action)
+            action.pattern = encode_pattern(action.pattern, encoding)
+            return [action]
+        program = self.empty_copy()
+        program.encoding = encoding
+        program.fs = encode_text(self.fs, encoding)
+        program.rs = encode_text(self.rs, encoding)
+        for name in ('begin', 'actions', 'end'):
+            actions = getattr(program, name)
+            for action in getattr(self, name):
+                if action.pattern in (Begin, End):
+                    actions.append(action)
+                else:
+                    actions.extend(encoded(action))
+        return program
+
+    def stateless(self):
+        '''whether every per line action is stateless, so the lines can be
+        processed in any order, see Action.stateless
+        '''
+        for action in self.actions:
+            if not action.stateless():
+                return False
+        return True
 
     def run(self):
         begin = copy(self.begin)
         actions = copy(self.actions)
         end = copy(self.end)
-        return AwkInstance(begin, actions, end)
+        instance = AwkInstance(begin, actions, end)
+        instance.fs = self.fs
+        instance.rs = self.rs
+        instance.use_fields = self.use_fields
+        instance.encoding = self.encoding
+        return instance
 
     def __call__(self):
         return self.run()
@@ -432,4 +1927,11 @@ __all__ = ['Either', 'Pattern', 'Begin', 'End', 'EveryLinePattern', 'RegexPatter
            'UnaryPattern', 'BinaryPattern', 'TrinaryPattern', 'AndPattern', 
            'OrPattern', 'RangePattern', 'NotPattern', 'IfThenPattern', 'MatchOrEveryLinePattern',
            'BaseHandler', 'PrintHandler', 'DoubleHandler', 'IncrementHandler', 'Action', 
-           'ActionOrPrint', 'Print', 'AwkInstance', 'AwkProgram', 'OneOfPattern']
+           'ActionOrPrint', 'Print', 'AwkInstance', 'AwkProgram', 'OneOfPattern',
+           'MultiRegexAction', 'AllOfPattern', 'AlternationPattern', 'FalsePattern',
+           'Record', 'FieldPattern', 'FieldComparePattern', 'split_fields',
+           'split_records', 'subpatterns', 'Aggregates', 'AggregateHandler',
+           'CountAction', 'SumAction', 'ReportHandler', 'ReportAction', 'MatchMemo', 'Profile',
+           'AwkFeed', 'QueueHandler', 'RecordSplitter',
+           'TextHandler', 'encode_pattern', 'KeyedRangePattern', 'Block',
+           'BlockHandler']
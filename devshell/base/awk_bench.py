@@ -0,0 +1,234 @@
+# Fedora Developer Shell
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+'''benchmarks devshell.base.awk against gawk
+
+every workload is one program written twice, as an AwkProgram and as awk
+source, and run over the same generated log corpus by the interpreter,
+the compiled backend (awk_codegen) and gawk.  every run happens in its
+own process, so the peak memory reported is that run's own.  the outputs
+must be identical (sorted first for workloads whose awk output order is
+not defined); without gawk only the python numbers are given.
+
+    python -m devshell.base.awk_bench --lines 1000000 --awk mawk
+'''
+
+import os
+import sys
+import random
+import tempfile
+from time import time
+from subprocess import Popen
+
+from devshell.base.awk import *
+from devshell.base.awk_io import run_files, FieldsHandler
+from devshell.base.awk_codegen import compile_program
+
+LEVELS = ['INFO'] * 6 + ['DEBUG'] * 3 + ['WARNING', 'ERROR']
+MESSAGES = ['request served in %dms', 'cache miss for key %d',
+            'db: connection timeout after %ds', 'upstream refused connection %d',
+            'health check ok %d', 'BEGIN TX %d', 'END TX %d',
+            'user %d logged in']
+
+
+def generate_corpus(filename, lines, seed=0):
+    '''writes lines of fake service logs to filename'''
+    rand = random.Random(seed)
+    fh = open(filename, 'w')
+    for i in xrange(lines):
+        fh.write('2009-01-%02d %02d:%02d:%02d host%d %s %s\n' % (
+                i % 28 + 1, i / 3600 % 24, i / 60 % 60, i % 60,
+                rand.randint(1, 40), rand.choice(LEVELS),
+                rand.choice(MESSAGES) % rand.randint(1, 5000)))
+    fh.close()
+
+
+def prefix(text):
+    def handler(awk, match, line):
+        yield text + line
+    handler.stateless = True
+    return handler
+
+def filter_only():
+    program = AwkProgram()
+    program.add_action(Action(RegexPattern('ERROR')))
+    return program
+
+def regex_heavy():
+    program = AwkProgram()
+    network = AndPattern(RegexPattern(r'timeout|refused'),
+                         NotPattern(RegexPattern(r'health')))
+    program.add_action(Action(network, prefix('net: ')))
+    program.add_action(Action(RegexPattern(r'served in [0-9]{3,}ms'),
+                              prefix('slow: ')))
+    program.add_action(Action(RegexPattern(r'^2009-01-0[1-7] .*(WARNING|ERROR)'),
+                              prefix('week1: ')))
+    return program
+
+def ranges():
+    program = AwkProgram()
+    program.add_action(Action(RangePattern(RegexPattern(r'BEGIN TX'),
+                                           RegexPattern(r'END TX'))))
+    return program
+
+def aggregation():
+    program = AwkProgram()
+    program.add_action(CountAction(EveryLinePattern, 'hosts', 3))
+    program.add_action(ReportAction('hosts'))
+    return program
+
+def print_heavy():
+    program = AwkProgram()
+    program.add_action(Action(EveryLinePattern, FieldsHandler([4, 3, 2])))
+    program.use_fields = True
+    return program
+
+# name, AwkProgram factory, awk source, whether the output needs sorting
+WORKLOADS = [
+    ('filter', filter_only, '/ERROR/', False),
+    ('regex', regex_heavy,
+     '/timeout|refused/ && !/health/ { print "net: " $0 }\n'
+     '/served in [0-9][0-9][0-9]+ms/ { print "slow: " $0 }\n'
+     '/^2009-01-0[1-7] .*(WARNING|ERROR)/ { print "week1: " $0 }', False),
+    ('range', ranges, '/BEGIN TX/,/END TX/', False),
+    ('aggregate', aggregation,
+     '{ count[$3]++ } END { for (host in count) print host, count[host] }',
+     True),
+    ('print', print_heavy, '{ print $4, $3, $2 }', False),
+]
+
+
+def find_awk(name):
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.access(path, os.X_OK):
+            return path
+    return None
+
+def run_python(make_program, compiled, corpus, output):
+    '''runs a workload in a forked child; returns (seconds, peak kB)'''
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            program = make_program()
+            if compiled:
+                instance = compile_program(program)
+            else:
+                instance = program.run()
+            fd = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+            start = time()
+            run_files(instance, [corpus], fd)
+            elapsed = time() - start
+            os.close(fd)
+            os.write(write_end, '%r\n' % elapsed)
+        except:
+            import traceback
+            traceback.print_exc()
+        finally:
+            os._exit(0)
+    os.close(write_end)
+    reply = os.read(read_end, 100)
+    os.close(read_end)
+    pid, status, usage = os.wait4(pid, 0)
+    if not reply:
+        raise RuntimeError('python run failed')
+    return float(reply), usage.ru_maxrss
+
+def run_awk(awk, source, corpus, output):
+    '''runs awk source in a child; returns (seconds, peak kB)'''
+    fh = open(output, 'w')
+    start = time()
+    child = Popen([awk, source, corpus], stdout=fh)
+    pid, status, usage = os.wait4(child.pid, 0)
+    elapsed = time() - start
+    child.returncode = status
+    fh.close()
+    if status:
+        raise RuntimeError('%s failed on %r' % (awk, source))
+    return elapsed, usage.ru_maxrss
+
+def read_output(filename, unordered):
+    fh = open(filename)
+    lines = fh.readlines()
+    fh.close()
+    if unordered:
+        lines.sort()
+    return lines
+
+
+def benchmark(lines=200000, awk='gawk', workloads=None, keep=False):
+    '''runs the workloads over a fresh corpus, returns a list of
+    (workload, engine, seconds, peak kB, lines per second, MB per second)'''
+    awk_path = find_awk(awk)
+    workdir = tempfile.mkdtemp(prefix='awk_bench.')
+    corpus = os.path.join(workdir, 'corpus.log')
+    generate_corpus(corpus, lines)
+    megabytes = os.path.getsize(corpus) / float(1 << 20)
+    results = []
+    for name, make_program, source, unordered in WORKLOADS:
+        if workloads and name not in workloads:
+            continue
+        runs = [('python', lambda out: run_python(make_program, False, corpus, out)),
+                ('compiled', lambda out: run_python(make_program, True, corpus, out))]
+        if awk_path:
+            runs.append((awk, lambda out: run_awk(awk_path, source, corpus, out)))
+        expected = None
+        for engine, run in runs:
+            output = os.path.join(workdir, '%s.%s.out' % (name, engine))
+            seconds, peak = run(output)
+            got = read_output(output, unordered)
+            if expected is None:
+                expected = got
+            elif got != expected:
+                raise AssertionError('%s output of %s differs from python, see %s'
+                                     % (engine, name, workdir))
+            results.append((name, engine, seconds, peak, lines / seconds,
+                            megabytes / seconds))
+    if not keep:
+        for filename in os.listdir(workdir):
+            os.remove(os.path.join(workdir, filename))
+        os.rmdir(workdir)
+    return results
+
+def format_results(results):
+    out = ['%-10s %-10s %9s %12s %9s %10s' % ('workload', 'engine', 'seconds',
+                                              'lines/s', 'MB/s', 'peak kB')]
+    for name, engine, seconds, peak, lines_sec, mb_sec in results:
+        out.append('%-10s %-10s %9.3f %12d %9.2f %10d' % (
+                name, engine, seconds, lines_sec, mb_sec, peak))
+    return '\n'.join(out)
+
+def main(argv=None):
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] [workload ...]",
+                          description='workloads: ' +
+                          ', '.join([w[0] for w in WORKLOADS]))
+    parser.add_option('-n', '--lines', dest='lines', type='int',
+                      default=200000, help='lines in the generated corpus')
+    parser.add_option('--awk', dest='awk', default='gawk',
+                      help='the awk to compare with')
+    parser.add_option('--keep', dest='keep', action='store_true',
+                      help='keep the corpus and outputs')
+    opts, args = parser.parse_args(argv)
+    if not find_awk(opts.awk):
+        print >> sys.stderr, '%s not found, only timing python' % opts.awk
+    print format_results(benchmark(opts.lines, opts.awk, args, opts.keep))
+
+if __name__ == '__main__':
+    main()
+
+__all__ = ['benchmark', 'format_results', 'generate_corpus', 'WORKLOADS']
@@ -0,0 +1,273 @@
+# Fedora Developer Shell
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+'''a backend that compiles an AwkProgram to one specialised python function
+
+AwkInstance.process interprets the program: every line goes through
+Action.match, the match methods of the whole pattern tree, a generator per
+handler and an Either for every ActionOrPrint.  compile_program() instead
+writes python source for the per line part of the program, with the
+patterns turned into inline expressions on local variables, the regex
+searches and literal prefilters inlined, PrintHandler and DoubleHandler
+inlined and the Either patterns unrolled into if/else, and execs it.
+patterns and handlers it does not know (RangePattern, custom classes) are
+called as they are, so the output is always the same as the interpreter's.
+
+run this module for a benchmark against the interpreter.
+'''
+
+from devshell.base.awk import *
+from devshell.base.awk import EitherOrPattern, EitherOrHandler, MatchOrPrintHandler
+from devshell.base.awk import Repeater, BarProgram
+
+
+def plain(obj, cls):
+    '''obj is a cls that does not override match'''
+    return isinstance(obj, cls) and type(obj).match.im_func is cls.match.im_func
+
+
+class CodeGenerator(object):
+    def __init__(self):
+        self.names = []
+        self.values = []
+        self.lines = []
+        self.temps = 0
+
+    def bind(self, prefix, value):
+        '''makes value available to the generated code, returns its name'''
+        name = '%s%d' % (prefix, len(self.names))
+        self.names.append(name)
+        self.values.append(value)
+        return name
+
+    def temp(self):
+        self.temps += 1
+        return 'm%d' % self.temps
+
+    def emit(self, depth, code):
+        self.lines.append('    ' * depth + code)
+
+    def prefilter(self, prefilter, expr):
+        if not prefilter:
+            return expr
+        names = [self.bind('lit', literal) for literal in prefilter]
+        check = ' or '.join('%s in line' % name for name in names)
+        return '(%s if %s else None)' % (expr, check)
+
+    def pattern(self, pattern):
+        '''an expression with the same value as pattern.match(line)'''
+        if type(pattern) is Pattern:
+            return 'True'
+        if type(pattern) is FalsePattern:
+            return 'False'
+        if plain(pattern, RegexPattern):
+            pattern.regex
+            if pattern.risky and pattern.max_risky_length is not None:
+                return '%s(line)' % self.bind('match', pattern.match)
+            search = self.bind('search', pattern._regex.search)
+            if pattern.test is not None:
+                test = self.bind('test', pattern.test)
+                return '(%s(line) and %s(line) or None)' % (test, search)
+            if pattern.literal is None:
+                return '%s(line)' % search
+            return self.prefilter([pattern.literal], '%s(line)' % search)
+        if plain(pattern, AndPattern):
+            return self.prefilter(pattern.prefilter(), '(%s and %s)' % (
+                self.pattern(pattern.first), self.pattern(pattern.second)))
+        if plain(pattern, OrPattern):
+            return '(%s or %s)' % (self.pattern(pattern.first),
+                                   self.pattern(pattern.second))
+        if plain(pattern, NotPattern):
+            return '(not %s)' % self.pattern(pattern.first)
+        if plain(pattern, IfThenPattern):
+            return '(%s if %s else %s)' % (self.pattern(pattern.second),
+                                           self.pattern(pattern.first),
+                                           self.pattern(pattern.third))
+        if plain(pattern, OneOfPattern):
+            branches = [self.pattern(child) for child in pattern.patterns]
+            return self.prefilter(pattern.prefilter(),
+                                  '(%s)' % ' or '.join(branches + ['None']))
+        if plain(pattern, AllOfPattern) and pattern.in_order:
+            return '(%s)' % ' and '.join(self.pattern(child)
+                                         for child in pattern.patterns)
+        return '%s(line)' % self.bind('match', pattern.match)
+
+    def handler(self, depth, handler, match):
+        if type(handler) is PrintHandler:
+            self.emit(depth, 'yield line')
+        elif type(handler) is DoubleHandler:
+            self.emit(depth, 'yield line')
+            self.emit(depth, 'yield line')
+        else:
+            name = self.bind('handler', handler)
+            result = self.temp()
+            self.emit(depth, '%s = %s(awk, %s, line)' % (result, name, match))
+            self.emit(depth, 'if %s:' % result)
+            self.emit(depth + 1, 'for out in %s:' % result)
+            self.emit(depth + 2, 'yield out')
+
+    def action(self, depth, action):
+        pattern = action.pattern
+        handler = action.handler
+        if isinstance(action, MultiRegexAction):
+            search = self.bind('screen', action.regex.search)
+            matches = self.bind('matches', action.matches)
+            found = self.temp()
+            self.emit(depth, '%s = %s(line)' % (found, search))
+            self.emit(depth, 'if %s is not None:' % found)
+            self.emit(depth + 1, '%s = %s(line, %s)' % (found, matches, found))
+            for i, member in enumerate(action.actions):
+                match = '%s[%d]' % (found, i)
+                self.emit(depth + 1, 'if %s:' % match)
+                if isinstance(member.pattern, MatchOrEveryLinePattern):
+                    self.handler(depth + 2, member.handler.right, match)
+                    self.emit(depth + 1, 'else:')
+                    self.handler(depth + 2, member.handler.left, 'True')
+                else:
+                    self.handler(depth + 2, member.handler, match)
+            either = [member for member in action.actions
+                      if isinstance(member.pattern, MatchOrEveryLinePattern)]
+            if either:
+                self.emit(depth, 'else:')
+                for member in either:
+                    self.handler(depth + 1, member.handler.left, 'True')
+            return
+        if type(action).match.im_func is not Action.match.im_func:
+            name = self.bind('action', action)
+            result = self.temp()
+            self.emit(depth, '%s = %s.match(awk, line)' % (result, name))
+            self.emit(depth, 'if %s:' % result)
+            self.emit(depth + 1, 'for out in %s:' % result)
+            self.emit(depth + 2, 'yield out')
+            return
+        match = self.temp()
+        either = type(handler) in (EitherOrHandler, MatchOrPrintHandler)
+        if either and plain(pattern, MatchOrEveryLinePattern):
+            self.emit(depth, '%s = %s' % (match, self.pattern(pattern.first)))
+            self.emit(depth, 'if %s:' % match)
+            self.handler(depth + 1, handler.right, match)
+            self.emit(depth, 'else:')
+            self.handler(depth + 1, handler.left, 'True')
+        elif either and plain(pattern, EitherOrPattern):
+            self.emit(depth, '%s = %s' % (match, self.pattern(pattern.first)))
+            self.emit(depth, 'if %s:' % match)
+            self.handler(depth + 1, handler.right, match)
+            self.emit(depth, 'else:')
+            self.emit(depth + 1, '%s = %s' % (match, self.pattern(pattern.second)))
+            self.handler(depth + 1, handler.left, match)
+        else:
+            self.emit(depth, '%s = %s' % (match, self.pattern(pattern)))
+            self.emit(depth, 'if %s:' % match)
+            self.handler(depth + 1, handler, match)
+
+    def program(self, actions):
+        '''returns the source of the per line function and its bindings'''
+        self.emit(1, 'def process_lines(awk, lines):')
+        self.emit(2, 'for line in lines:')
+        for action in actions:
+            self.action(3, action)
+        self.emit(3, 'awk.nr += 1')
+        self.emit(2, 'if False:')
+        self.emit(3, 'yield')
+        self.emit(1, 'return process_lines')
+        head = 'def make_process_lines(%s):' % ', '.join(self.names)
+        return '\n'.join([head] + self.lines) + '\n'
+
+
+def generate(actions):
+    '''returns (source, function) for a list of per line actions'''
+    generator = CodeGenerator()
+    source = generator.program(actions)
+    namespace = {}
+    exec compile(source, '<awk program>', 'exec') in namespace
+    return source, namespace['make_process_lines'](*generator.values)
+
+
+class CompiledAwkInstance(AwkInstance):
+    '''an AwkInstance whose per line actions run as generated code'''
+    def __init__(self, begin, actions, end):
+        AwkInstance.__init__(self, begin, actions, end)
+        self.source, self.process_lines = generate(actions)
+
+    def line_runner(self):
+        return lambda lines: self.process_lines(self, lines)
+
+
+def compile_program(program):
+    '''returns a CompiledAwkInstance for an AwkProgram, the equivalent of
+    program.run()'''
+    instance = program.run()
+    compiled = CompiledAwkInstance(instance.begin, instance.actions, instance.end)
+    compiled.fs = instance.fs
+    compiled.rs = instance.rs
+    compiled.use_fields = instance.use_fields
+    compiled.encoding = instance.encoding
+    return compiled
+
+
+def benchmark(program, lines, repeat=3):
+    '''times the interpreter against the compiled program over lines
+
+    returns (interpreted seconds, compiled seconds); the outputs must be
+    identical
+    '''
+    from time import time
+    timings = []
+    outputs = []
+    for run in (lambda: program.run(), lambda: compile_program(program)):
+        best = None
+        for i in xrange(repeat):
+            instance = run()
+            start = time()
+            output = list(instance(lines))
+            elapsed = time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        timings.append(best)
+        outputs.append(output)
+    assert outputs[0] == outputs[1], 'compiled program output differs'
+    return tuple(timings)
+
+def demonstrate():
+    import re
+    import random
+    levels = ['INFO', 'INFO', 'INFO', 'WARNING', 'ERROR', 'DEBUG']
+    lines = ['2009-01-%02d 12:00:%02d %s worker%d: %s\n' % (
+                 i % 28 + 1, i % 60, random.choice(levels), i % 7,
+                 random.choice(['request served', 'db timeout', 'cache miss',
+                                'Traceback (most recent call last):']))
+             for i in xrange(100000)]
+    def tag(name):
+        def handler(awk, match, line):
+            yield name + ': ' + line
+        return handler
+    program = AwkProgram()
+    program.add_action(Action(AndPattern(RegexPattern('ERROR'),
+                                         RegexPattern('db timeout')), tag('db')))
+    program.add_action(ActionOrPrint(RegexPattern(r'^\S+ \S+ WARNING'), tag('warn')))
+    program.add_action(Action(OneOfPattern(RegexPattern('Traceback'),
+                                           RegexPattern('worker6: cache', re.I)),
+                              tag('other')))
+    for name, prog in (('rules', program), ('repeater', Repeater),
+                       ('bar', BarProgram)):
+        interpreted, compiled = benchmark(prog, lines)
+        print '%-10s interpreted %.3fs compiled %.3fs speedup %.2fx' % (
+            name, interpreted, compiled, interpreted / compiled)
+
+if __name__ == '__main__':
+    demonstrate()
+
+__all__ = ['compile_program', 'CompiledAwkInstance', 'generate', 'benchmark']
@@ -0,0 +1,261 @@
+# Fedora Developer Shell
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+'''a block oriented I/O driver for AwkInstances
+
+the input is read with os.read in blocks of BLOCK_SIZE and split into
+records a block at a time; the output is collected and written with one
+os.write per BLOCK_SIZE of output.  run this module for a small awk:
+
+    python -m devshell.base.awk_io -F: -e '/bin/bash$' --print 1,7 /etc/passwd
+'''
+
+import os
+import sys
+from cStringIO import StringIO
+
+from devshell.base.awk import *
+
+BLOCK_SIZE = 1 << 20
+
+
+def read_blocks(fd, block_size=BLOCK_SIZE):
+    '''the contents of a file descriptor, in blocks of up to block_size'''
+    read = os.read
+    while True:
+        block = read(fd, block_size)
+        if not block:
+            return
+        yield block
+
+
+def block_lines(blocks):
+    '''the newline terminated lines of a stream of blocks
+
+    a block is split with one readlines call; the unterminated tail of a
+    block is carried over to the next one
+    '''
+    carry = ''
+    for block in blocks:
+        if carry:
+            block = carry + block
+        lines = StringIO(block).readlines()
+        if lines[-1][-1] != '\n':
+            carry = lines.pop()
+        else:
+            carry = ''
+        for line in lines:
+            yield line
+    if carry:
+        yield carry
+
+
+def input_stream(blocks, rs='\n'):
+    '''what AwkInstance.process wants for rs: lines for the default rs,
+    the raw blocks for any other, as AwkInstance.records splits those'''
+    if rs == '\n':
+        return block_lines(blocks)
+    return blocks
+
+
+class BlockWriter(object):
+    '''collects output and writes it to a file descriptor in blocks'''
+    def __init__(self, fd, block_size=BLOCK_SIZE):
+        self.fd = fd
+        self.block_size = block_size
+        self.pending = []
+        self.size = 0
+
+    def write(self, data):
+        self.pending.append(data)
+        self.size += len(data)
+        if self.size >= self.block_size:
+            self.flush()
+
+    def writelines(self, lines):
+        '''writes every line of an iterable'''
+        pending = self.pending
+        block_size = self.block_size
+        size = self.size
+        for line in lines:
+            pending.append(line)
+            size += len(line)
+            if size >= block_size:
+                self.size = size
+                self.flush()
+                pending = self.pending
+                size = 0
+        self.size = size
+
+    def flush(self):
+        if not self.pending:
+            return
+        data = ''.join(self.pending)
+        self.pending = []
+        self.size = 0
+        while data:
+            written = os.write(self.fd, data)
+            data = data[written:]
+
+    def close(self):
+        self.flush()
+
+
+def open_input(source):
+    '''a file descriptor for a path, a file object or a file descriptor,
+    and whether the caller has to close it'''
+    if isinstance(source, (int, long)):
+        return source, False
+    if hasattr(source, 'fileno'):
+        return source.fileno(), False
+    return os.open(source, os.O_RDONLY), True
+
+
+def run_files(instance, sources, output=1, block_size=BLOCK_SIZE):
+    '''runs an AwkInstance over sources (paths, file objects or file
+    descriptors, one after the other as one input) and writes the output
+    to the file descriptor output'''
+    def blocks():
+        for source in sources:
+            fd, opened = open_input(source)
+            try:
+                for block in read_blocks(fd, block_size):
+                    yield block
+            finally:
+                if opened:
+                    os.close(fd)
+    writer = BlockWriter(output, block_size)
+    try:
+        writer.writelines(instance(input_stream(blocks(), instance.rs)))
+    finally:
+        writer.close()
+
+
+class RecordHandler(object):
+    '''prints the record followed by ors, as awk's print with ORS set
+
+    records read with the default rs keep their newline, give strip to
+    have ors take its place'''
+    stateless = True
+
+    def __init__(self, ors='\n', strip=False):
+        self.ors = ors
+        self.strip = strip
+
+    def __call__(self, awk, match, line):
+        if self.strip and line.endswith('\n'):
+            line = line[:-1]
+        yield line + self.ors
+
+
+class FieldsHandler(object):
+    '''prints some fields of the record, separated by ofs and followed by
+    ors'''
+    stateless = True
+
+    def __init__(self, fields, ofs=' ', ors='\n'):
+        self.fields = fields
+        self.ofs = ofs
+        self.ors = ors
+
+    def __call__(self, awk, match, line):
+        yield self.ofs.join([line.field(n) for n in self.fields]) + self.ors
+
+
+def parse_fields(text):
+    return [int(n) for n in text.split(',') if n]
+
+def main(argv=None):
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] [file ...]",
+                          description='runs a small awk program over the '
+                          'files, or stdin')
+    parser.add_option('-F', dest='fs', default=' ',
+                      help='field separator, as awk -F')
+    parser.add_option('--rs', dest='rs', default='\n',
+                      help='record separator, as awk RS')
+    parser.add_option('--ors', dest='ors', default='\n',
+                      help='output record separator, as awk ORS')
+    parser.add_option('-e', '--regex', dest='regex',
+                      help='select the records matching this regex, '
+                      'instead of all of them')
+    parser.add_option('-i', '--ignore-case', action='store_true',
+                      dest='ignore_case', help='match the regex ignoring case')
+    parser.add_option('-v', '--invert', action='store_true', dest='invert',
+                      help='select the records that do not match')
+    parser.add_option('--print', dest='print_fields', metavar='N,M',
+                      help='print these fields instead of the record')
+    parser.add_option('--ofs', dest='ofs', default=' ',
+                      help='separator between printed fields')
+    parser.add_option('--count', dest='count', type='int', metavar='N',
+                      help='count the matching records per value of field N '
+                      'and print the counts at the end')
+    parser.add_option('--sum', dest='sum', metavar='K,V',
+                      help='sum field V per value of field K and print the '
+                      'sums at the end')
+    parser.add_option('--top', dest='top', type='int', metavar='K',
+                      help='only print the K highest counts or sums')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+                      help='run in this many processes')
+    parser.add_option('--block-size', dest='block_size', type='int',
+                      default=BLOCK_SIZE, help='bytes per read and write')
+    opts, args = parser.parse_args(argv)
+
+    import re
+    pattern = EveryLinePattern
+    if opts.regex is not None:
+        flags = opts.ignore_case and re.I or 0
+        pattern = RegexPattern(opts.regex, flags)
+    if opts.invert:
+        pattern = NotPattern(pattern)
+    program = AwkProgram()
+    program.fs = opts.fs
+    program.rs = opts.rs
+    if opts.count is not None:
+        program.add_action(CountAction(pattern, 'aggregate', opts.count))
+    elif opts.sum:
+        try:
+            key, value = parse_fields(opts.sum)
+        except ValueError:
+            parser.error('--sum takes two field numbers, eg. --sum 1,3')
+        program.add_action(SumAction(pattern, 'aggregate', key, value))
+    elif opts.print_fields:
+        program.add_action(Action(pattern, FieldsHandler(
+                    parse_fields(opts.print_fields), opts.ofs, opts.ors)))
+        program.use_fields = True
+    elif opts.rs == '\n' and opts.ors == '\n':
+        # the lines keep their newline, print them as they are
+        program.add_action(Action(pattern))
+    else:
+        program.add_action(Action(pattern, RecordHandler(
+                    opts.ors, opts.rs == '\n')))
+    if opts.count is not None or opts.sum:
+        program.add_action(ReportAction('aggregate', opts.top))
+
+    if opts.jobs > 1:
+        from devshell.base.awk_parallel import parallel_program
+        instance = parallel_program(program, opts.jobs)
+    else:
+        from devshell.base.awk_codegen import compile_program
+        instance = compile_program(program)
+    run_files(instance, args or [sys.stdin], sys.stdout.fileno(),
+              opts.block_size)
+
+if __name__ == '__main__':
+    main()
+
+__all__ = ['BLOCK_SIZE', 'read_blocks', 'block_lines', 'BlockWriter',
+           'run_files']
@@ -0,0 +1,189 @@
+# Fedora Developer Shell
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+'''linear time tests for the simple regexes most awk rules are
+
+a regex that is a literal, a set of literals (foo|bar, ba[rz]), either of
+them anchored at the start or the end of the line, or the whole line,
+matches a line exactly when one of a handful of str operations (in,
+startswith, endswith with a tuple, a set lookup) says so.  literal_test()
+returns that test, or None for any other regex.  a RegexPattern with a
+test decides every line with it, in C and in linear time, and only runs
+re to get the MatchObject of a line that does match.
+
+backtracking_risk() spots regexes that can take exponential time in re
+(nested unbounded repeats, backreferences), for RegexPattern to guard.
+'''
+
+import re
+import sre_parse
+from sre_constants import LITERAL, IN, BRANCH, SUBPATTERN, AT, \
+     AT_BEGINNING, AT_BEGINNING_STRING, AT_END, AT_END_STRING, \
+     MAX_REPEAT, MIN_REPEAT, GROUPREF, GROUPREF_EXISTS, MAXREPEAT
+
+# more alternatives than this are left to re
+MAX_LITERALS = 64
+
+
+def _literals(items):
+    '''the strings a sequence of parsed items matches, in the order re tries
+    them, or None when it is not just ascii literals'''
+    results = ['']
+    for op, av in items:
+        if op == LITERAL and av < 128:
+            options = [chr(av)]
+        elif op == IN:
+            if not all(sub_op == LITERAL and sub_av < 128
+                       for sub_op, sub_av in av):
+                return None
+            options = [chr(sub_av) for sub_op, sub_av in av]
+        elif op == BRANCH:
+            options = []
+            for branch in av[1]:
+                found = _literals(branch)
+                if found is None:
+                    return None
+                options.extend(found)
+        elif op == SUBPATTERN and av[0] is None:
+            options = _literals(av[1])
+            if options is None:
+                return None
+        else:
+            return None
+        results = [head + tail for head in results for tail in options]
+        if len(results) > MAX_LITERALS:
+            return None
+    return results
+
+def literal_set(regex_str, flags=0):
+    '''(literals, start, end) for a regex that matches exactly the lines
+    containing one of the literals, at the start of the line when start is
+    set, or at the end when end is (AT_END for $, AT_END_STRING for \\Z);
+    None when the regex is not that simple
+
+    as with required_literals only ascii literals are taken, as str, so
+    they can be looked for in str and unicode lines alike'''
+    if flags & (re.I | re.L):
+        return None
+    try:
+        parsed = sre_parse.parse(regex_str, flags)
+    except (re.error, AssertionError, OverflowError):
+        return None
+    if parsed.pattern.flags & (re.I | re.L):
+        return None
+    items = list(parsed)
+    multiline = parsed.pattern.flags & re.M
+    start = end = None
+    if items and items[0][0] == AT:
+        start = items.pop(0)[1]
+        if start not in (AT_BEGINNING, AT_BEGINNING_STRING):
+            return None
+        if start == AT_BEGINNING and multiline:
+            return None
+    if items and items[-1][0] == AT:
+        end = items.pop()[1]
+        if end not in (AT_END, AT_END_STRING):
+            return None
+        if end == AT_END and multiline:
+            return None
+    literals = _literals(items)
+    if not literals or '' in literals:
+        return None
+    if end is not None and [lit for lit in literals if '\n' in lit]:
+        return None
+    return literals, start, end
+
+def literal_test(regex_str, flags=0):
+    '''a function of a line that is true when regex_str matches somewhere in
+    it, or None when the regex is not simple enough, see literal_set'''
+    found = literal_set(regex_str, flags)
+    if found is None:
+        return None
+    literals, start, end = found
+    return _build(literals, start is not None, end == AT_END, end is not None)
+
+def _build(literals, anchored, before_newline, at_end):
+    '''before_newline: $ also matches before a newline ending the line'''
+    if anchored and at_end:
+        whole = frozenset(literals)
+        if before_newline:
+            return lambda line: line in whole or \
+                   (line[-1:] == '\n' and line[:-1] in whole)
+        return lambda line: line in whole
+    literals = tuple(literals)
+    if anchored:
+        return lambda line: line.startswith(literals)
+    if at_end:
+        if before_newline:
+            return lambda line: line.endswith(literals) or \
+                   (line[-1:] == '\n' and line.endswith(literals, 0, -1))
+        return lambda line: line.endswith(literals)
+    if len(literals) == 1:
+        literal, = literals
+        return lambda line: literal in line
+    def test(line):
+        for literal in literals:
+            if literal in line:
+                return True
+        return False
+    return test
+
+
+def _repeats(items):
+    '''whether parsed items contain an unbounded or long repeat'''
+    for op, av in items:
+        if op in (MAX_REPEAT, MIN_REPEAT):
+            if av[1] == MAXREPEAT or av[1] > 1:
+                return True
+            if _repeats(av[2]):
+                return True
+        elif op == SUBPATTERN:
+            if _repeats(av[1]):
+                return True
+        elif op == BRANCH:
+            for branch in av[1]:
+                if _repeats(branch):
+                    return True
+    return False
+
+def _risky(items):
+    for op, av in items:
+        if op in (GROUPREF, GROUPREF_EXISTS):
+            return True
+        if op in (MAX_REPEAT, MIN_REPEAT):
+            if (av[1] == MAXREPEAT or av[1] > 1) and _repeats(av[2]):
+                return True
+            if _risky(av[2]):
+                return True
+        elif op == SUBPATTERN:
+            if _risky(av[1]):
+                return True
+        elif op == BRANCH:
+            for branch in av[1]:
+                if _risky(branch):
+                    return True
+    return False
+
+def backtracking_risk(regex_str, flags=0):
+    '''whether re may need exponential time on some lines for the regex:
+    it repeats something that repeats itself, eg. (a+)+ or (\\w+\\s*)*,
+    or uses backreferences'''
+    try:
+        return _risky(sre_parse.parse(regex_str, flags))
+    except (re.error, AssertionError, OverflowError):
+        return False
+
+__all__ = ['literal_set', 'literal_test', 'backtracking_risk']
@@ -0,0 +1,292 @@
+# Fedora Developer Shell
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+'''an optimizer for trees of devshell.base.awk patterns
+
+optimize() returns an equivalent pattern tree that is cheaper to evaluate:
+
+ * constant patterns (EveryLinePattern, FalsePattern) are folded away
+ * chains of AndPatterns become one AllOfPattern, chains of OrPatterns and
+   nested OneOfPatterns become one OneOfPattern
+ * operands of stateless AllOfPatterns are evaluated cheapest and most
+   selective first; OneOfPatterns are reordered only where their match
+   is never handed to anyone
+ * runs of RegexPatterns inside a OneOfPattern become an AlternationPattern
+
+whatever a handler receives as the match is unchanged, and stateful
+patterns (RangePattern) are never reordered or dropped.  with a sample of
+lines the selectivity and cost of each operand are measured, otherwise
+they are guessed.
+'''
+
+import re
+import sre_parse
+from copy import copy
+from time import time
+from sre_constants import AT, AT_BEGINNING, AT_BEGINNING_STRING
+
+from devshell.base.awk import *
+from devshell.base.awk import screen_source
+
+TRUE = EveryLinePattern
+FALSE = FalsePattern()
+
+
+def is_true(pattern):
+    '''the plain Pattern matches every line'''
+    return type(pattern) is Pattern and pattern is not Begin and pattern is not End
+
+def is_false(pattern):
+    return type(pattern) is FalsePattern
+
+
+class Estimates(object):
+    '''selectivity (fraction of lines matched) and cost per line of patterns
+
+    measured on sample when one is given, guessed otherwise
+    '''
+    def __init__(self, sample=None):
+        self.sample = sample
+        self.known = {}
+
+    def __call__(self, pattern):
+        key = id(pattern)
+        if key not in self.known:
+            if self.sample and pattern.stateless():
+                self.known[key] = self.measure(pattern)
+            else:
+                self.known[key] = self.guess(pattern)
+        return self.known[key]
+
+    def measure(self, pattern):
+        match = pattern.match
+        matched = 0
+        start = time()
+        for line in self.sample:
+            if match(line):
+                matched += 1
+        elapsed = time() - start
+        n = float(len(self.sample))
+        return matched / n, elapsed / n
+
+    def guess(self, pattern):
+        if is_true(pattern):
+            return 1.0, 0.01
+        if is_false(pattern):
+            return 0.0, 0.01
+        if isinstance(pattern, RegexPattern):
+            if pattern.prefilter():
+                return 0.1, 0.3
+            return 0.5, 1.0
+        if isinstance(pattern, NotPattern):
+            selectivity, cost = self(pattern.first)
+            return 1.0 - selectivity, cost + 0.1
+        if isinstance(pattern, (AndPattern, AllOfPattern)):
+            selectivity, cost = 1.0, 0.1
+            for child in subpatterns(pattern):
+                child_sel, child_cost = self(child)
+                cost += selectivity * child_cost
+                selectivity *= child_sel
+            return selectivity, cost
+        if isinstance(pattern, (OrPattern, OneOfPattern, AlternationPattern)):
+            missed, cost = 1.0, 0.1
+            for child in subpatterns(pattern):
+                child_sel, child_cost = self(child)
+                cost += missed * child_cost
+                missed *= 1.0 - child_sel
+            return 1.0 - missed, cost
+        return 0.5, 1.0
+
+
+def rebuild(pattern, new_children):
+    '''a copy of a composite pattern with other children'''
+    new = copy(pattern)
+    if isinstance(pattern, OneOfPattern):
+        new.patterns = tuple(new_children)
+        new._prefilter = None
+    elif isinstance(pattern, TrinaryPattern):
+        new.first, new.second, new.third = new_children
+    elif isinstance(pattern, BinaryPattern):
+        new.first, new.second = new_children
+        new._prefilter = None
+    elif isinstance(pattern, UnaryPattern):
+        new.first, = new_children
+    return new
+
+
+def anchored(pattern):
+    '''the regex can only match at the start of the line'''
+    if pattern.flags & re.M:
+        return False
+    try:
+        parsed = sre_parse.parse(pattern.regex_str, pattern.flags)
+    except (re.error, AssertionError):
+        return False
+    if parsed.pattern.flags & re.M or not len(parsed):
+        return False
+    op, av = parsed[0]
+    return op == AT and av in (AT_BEGINNING, AT_BEGINNING_STRING)
+
+def mergeable(pattern):
+    return isinstance(pattern, RegexPattern) and \
+           type(pattern).match.im_func is RegexPattern.match.im_func and \
+           screen_source(pattern.regex_str) is not None
+
+def merge_alternatives(patterns):
+    '''replaces runs of mergeable RegexPatterns with AlternationPatterns'''
+    merged = []
+    run = []
+    def close_run():
+        if len(run) > 1:
+            merged.append(AlternationPattern(list(run),
+                                             all(map(anchored, run))))
+        else:
+            merged.extend(run)
+        del run[:]
+    for pattern in patterns:
+        if not mergeable(pattern):
+            close_run()
+            merged.append(pattern)
+            continue
+        if run and run[0].flags != pattern.flags:
+            close_run()
+        run.append(pattern)
+    close_run()
+    return merged
+
+
+class Optimizer(object):
+    def __init__(self, sample=None):
+        self.estimate = Estimates(sample)
+
+    def __call__(self, pattern, needs_value=True):
+        '''returns the optimized pattern
+
+        needs_value says whether anyone looks at the match returned, or
+        only at whether it is true
+        '''
+        if isinstance(pattern, (AndPattern, AllOfPattern)):
+            return self.all_of(pattern, needs_value)
+        if isinstance(pattern, (OrPattern, OneOfPattern)):
+            return self.one_of(pattern, needs_value)
+        if isinstance(pattern, NotPattern):
+            first = self(pattern.first, False)
+            if is_true(first):
+                return FALSE
+            if is_false(first):
+                return TRUE
+            return rebuild(pattern, [first])
+        if isinstance(pattern, IfThenPattern):
+            first = self(pattern.first, False)
+            second = self(pattern.second, needs_value)
+            third = self(pattern.third, needs_value)
+            if is_true(first):
+                return second
+            if is_false(first):
+                return third
+            return rebuild(pattern, [first, second, third])
+        # RangePattern, the Either patterns and anything unknown: only
+        # their children are optimized, the pattern itself stays as it is
+        kids = subpatterns(pattern)
+        if not kids:
+            return pattern
+        return rebuild(pattern, [self(child, True) for child in kids])
+
+    def flatten(self, pattern, kinds):
+        if isinstance(pattern, kinds):
+            flat = []
+            for child in subpatterns(pattern):
+                flat.extend(self.flatten(child, kinds))
+            return flat
+        return [pattern]
+
+    def all_of(self, pattern, needs_value):
+        flat = self.flatten(pattern, (AndPattern, AllOfPattern))
+        last = len(flat) - 1
+        operands = [self(child, needs_value and i == last)
+                    for i, child in enumerate(flat)]
+        folded = []
+        for i, operand in enumerate(operands):
+            if is_false(operand):
+                # nothing after a false operand is ever evaluated
+                if all(p.stateless() for p in folded):
+                    return FALSE
+                folded.append(operand)
+                break
+            if is_true(operand) and (i < last or not needs_value):
+                continue
+            folded.append(operand)
+        if not folded:
+            return TRUE
+        if len(folded) == 1:
+            return folded[0]
+        order = range(len(folded))
+        if all(operand.stateless() for operand in folded):
+            def rank(i):
+                selectivity, cost = self.estimate(folded[i])
+                return cost / max(1.0 - selectivity, 1e-6)
+            order.sort(key=rank)
+        if len(folded) == 2 and order == [0, 1]:
+            return AndPattern(*folded)
+        return AllOfPattern(folded, order)
+
+    def one_of(self, pattern, needs_value):
+        flat = self.flatten(pattern, (OrPattern, OneOfPattern))
+        operands = []
+        for child in flat:
+            operand = self(child, needs_value)
+            if is_false(operand) and operand.stateless():
+                continue
+            operands.append(operand)
+            if is_true(operand):
+                break
+        if not operands:
+            return FALSE
+        if not needs_value and all(operand.stateless() for operand in operands):
+            def rank(operand):
+                selectivity, cost = self.estimate(operand)
+                return cost / max(selectivity, 1e-6)
+            operands.sort(key=rank)
+        operands = merge_alternatives(operands)
+        if len(operands) == 1:
+            return operands[0]
+        return OneOfPattern(*operands)
+
+
+def optimize(pattern, sample=None):
+    '''returns an optimized copy of pattern, see the module docstring
+
+    sample is an optional list of representative lines
+    '''
+    return Optimizer(sample)(pattern)
+
+def optimize_program(program, sample=None):
+    '''returns a copy of an AwkProgram with the patterns of its per line
+    actions optimized'''
+    optimizer = Optimizer(sample)
+    new = program.empty_copy()
+    new.begin = copy(program.begin)
+    new.end = copy(program.end)
+    for action in program.actions:
+        if isinstance(action, MultiRegexAction):
+            new.actions.append(action)
+            continue
+        action = copy(action)
+        action.pattern = optimizer(action.pattern)
+        new.actions.append(action)
+    return new
+
+__all__ = ['optimize', 'optimize_program', 'Optimizer']
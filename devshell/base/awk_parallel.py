@@ -0,0 +1,145 @@
+# Fedora Developer Shell
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+'''runs the per line actions of a stateless AwkProgram in several processes
+
+a program is stateless when none of its per line patterns or handlers
+depend on the lines before the current one (see AwkProgram.stateless), so
+its input can be cut into chunks that are processed independently.  the
+BEGIN and END actions still run once, in the calling process, and the
+output comes out in input order, the same as program.run() would give.
+every chunk collects its own Aggregates, which are merged into the
+instance before END runs.  programs that are not stateless run serially.
+
+the worker processes are forked with the program already in place, so
+patterns and handlers never need to be pickled; only the lines and the
+output cross between processes.
+'''
+
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+
+from devshell.base.awk import *
+from devshell.base.awk import make_record, RecordFields
+
+# the instance the forked workers run, set just before the pool is created
+_instance = None
+
+
+def chunks(records, chunk_size, start=0):
+    '''(number of the first record, list of records) for every chunk_size
+    records'''
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+        yield start, chunk
+        start += len(chunk)
+
+
+def _plain(out):
+    '''Records carry their split fields, which are not worth sending back'''
+    if isinstance(out, RecordFields):
+        if isinstance(out, unicode):
+            return unicode(out)
+        return str(out)
+    return out
+
+def _run_chunk(chunk):
+    start, lines = chunk
+    awk = _instance
+    actions = awk.actions
+    use_fields = awk.use_fields
+    fs = awk.fs
+    output = []
+    awk.nr = start
+    awk.agg = Aggregates()
+    for line in lines:
+        if use_fields:
+            line = make_record(line, fs)
+        for action in actions:
+            result = action.match(awk, line)
+            if result:
+                for out in result:
+                    output.append(_plain(out))
+        awk.nr += 1
+    return len(lines), output, awk.agg
+
+
+class ParallelAwkInstance(AwkInstance):
+    '''an AwkInstance that spreads the per line actions over processes
+
+    processes defaults to the number of cpus, chunk_size is the number of
+    records handed to a worker at a time
+    '''
+    def __init__(self, begin, actions, end, processes=None, chunk_size=10000):
+        AwkInstance.__init__(self, begin, actions, end)
+        self.processes = processes or cpu_count()
+        self.chunk_size = chunk_size
+
+    def stateless(self):
+        for action in self.actions:
+            if not action.stateless():
+                return False
+        return True
+
+    def process(self, generator):
+        if self.processes < 2 or not self.stateless():
+            for out in AwkInstance.process(self, generator):
+                yield out
+            return
+        for out in self.run_once(self.begin):
+            yield out
+        records = generator
+        if self.rs != '\n':
+            records = split_records(generator, self.rs)
+        global _instance
+        _instance = self
+        pool = Pool(self.processes)
+        _instance = None
+        work = chunks(records, self.chunk_size, self.nr)
+        try:
+            for count, output, agg in pool.imap(_run_chunk, work):
+                self.nr += count
+                self.agg.merge(agg)
+                for out in output:
+                    yield out
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        for out in self.run_once(self.end):
+            yield out
+
+
+def parallel_program(program, processes=None, chunk_size=10000):
+    '''returns a ParallelAwkInstance for an AwkProgram, the equivalent of
+    program.run()'''
+    instance = program.run()
+    parallel = ParallelAwkInstance(instance.begin, instance.actions,
+                                   instance.end, processes, chunk_size)
+    parallel.fs = instance.fs
+    parallel.rs = instance.rs
+    parallel.use_fields = instance.use_fields
+    parallel.encoding = instance.encoding
+    return parallel
+
+def run_parallel(program, lines, processes=None, chunk_size=10000):
+    '''runs program over lines, returns an iterator over the output'''
+    return parallel_program(program, processes, chunk_size)(lines)
+
+__all__ = ['ParallelAwkInstance', 'parallel_program', 'run_parallel']
@@ -17,11 +17,18 @@
 #
 from __future__ import with_statement
 
+import os
 import re
-import rpm
+import stat
+import pipes
+import shlex
 import string
 import time
+import tempfile
 
+from bisect import insort
+from hashlib import md5
+from os.path import abspath, getmtime, realpath
 from subprocess import Popen, PIPE
 from contextlib import contextmanager
 from functools import partial
@@ -29,17 +36,305 @@ from functools import partial
 from devshell.base.base import log
 from devshell.base.awk import *
 
+try:
+    import rpm
+except ImportError:
+    # without the bindings, specs are queried by running rpm
+    rpm = None
+
+# rpm 4.9 and later have rpm.spec, whose objects list the packages the spec
+# builds; older bindings only have ts.parseSpec, and those specs are queried
+# by running rpm as well
+SPEC_PACKAGES = rpm is not None and hasattr(rpm, 'spec')
+
+# the tags fetched together, and cached, by RPMSpec.tags
+QUERY_TAGS = ('name', 'epoch', 'version', 'release')
+MAX_CACHED_SPECS = 256
+
+# (spec file, mtime, md5 of the contents, defines) -> tags of the spec
+_spec_cache = {}
+
+def defines_string(defines):
+    '''defines as rpm arguments for the shell, from a string or a list such
+    as the dist_defines of a profile'''
+    if isinstance(defines, basestring):
+        return defines
+    return ' '.join([pipes.quote(define) for define in defines])
+
+def define_macros(defines):
+    '''{macro: value} for the -D/--define arguments in defines'''
+    if isinstance(defines, basestring):
+        defines = shlex.split(defines)
+    macros = {}
+    defines = list(defines)
+    for i, arg in enumerate(defines):
+        if arg in ('-D', '--define'):
+            arg = defines[i + 1:i + 2] and defines[i + 1] or ''
+        elif arg.startswith('--define='):
+            arg = arg[len('--define='):]
+        elif arg.startswith('-D'):
+            arg = arg[2:]
+        else:
+            continue
+        parts = arg.strip().split(None, 1)
+        if parts:
+            macros[parts[0]] = len(parts) > 1 and parts[1] or ''
+    return macros
+
+def parse_spec(spec_file, defines=''):
+    '''the spec file parsed by the rpm bindings, with the defines set as
+    macros while it is parsed'''
+    with rpm_macros(**define_macros(defines)):
+        if hasattr(rpm, 'spec'):
+            return rpm.spec(spec_file)
+        return rpm.TransactionSet().parseSpec(spec_file)
+
+def header_value(header, tag):
+    '''a tag of a header as rpm -q --qf would print it'''
+    value = header[tag]
+    if value is None or value == []:
+        return '(none)'
+    if isinstance(value, list):
+        return ' '.join([str(item) for item in value])
+    return str(value)
+
+# the sections that end the preamble, as in rpmbuild's parseSpec
+SECTIONS = ('package', 'description', 'prep', 'build', 'install', 'check',
+            'clean', 'files', 'changelog', 'pre', 'post', 'preun', 'postun',
+            'pretrans', 'posttrans', 'triggerprein', 'triggerin',
+            'triggerun', 'triggerpostun', 'verifyscript')
+
+section_re = re.compile(r'^%%(%s)(\s|$)' % '|'.join(SECTIONS))
+tag_re = re.compile(r'^(?P<key>[A-Za-z][\w()-]*)\s*:\s*(?P<value>.*?)\s*$')
+macro_re = re.compile(r'^%(?:global|define)\s+(?P<key>\w+)(?:\(.*?\))?\s+'
+                      r'(?P<value>.*?)\s*$')
+numbered_re = re.compile(r'^(source|patch)(\d*)$')
+
+
+class SpecDocument(object):
+    '''the lines of a spec with an index of where things are defined
+
+    tags maps the lowercased tags of the preambles (the main one and those
+    of %package sections) to their line numbers, macros the %global and
+    %define names, sources and patches the SourceN and PatchN numbers;
+    changelog is the line number of %changelog and sections the (line
+    number, name) of every section.  every definition of a name is indexed,
+    in a list in the order of the lines, as rpm may see any of them.
+
+    rewrite() replaces a line and keeps the index up to date by shifting
+    the line numbers after it, and only indexes everything again when the
+    sections change.
+    '''
+    def __init__(self, lines):
+        self.lines = lines
+        self.index()
+
+    def indexes(self):
+        return (self.tags, self.macros, self.sources, self.patches)
+
+    def copy(self):
+        document = SpecDocument.__new__(SpecDocument)
+        document.lines = list(self.lines)
+        document.sections = list(self.sections)
+        for name in ('tags', 'macros', 'sources', 'patches'):
+            setattr(document, name, dict((key, list(numbers)) for key, numbers
+                                         in getattr(self, name).iteritems()))
+        document.changelog = self.changelog
+        return document
+
+    def index(self):
+        self.sections = []
+        self.tags = {}
+        self.macros = {}
+        self.sources = {}
+        self.patches = {}
+        self.changelog = None
+        for number, line in enumerate(self.lines):
+            match = section_re.match(line)
+            if match:
+                self.sections.append((number, match.group(1)))
+                if match.group(1) == 'changelog' and self.changelog is None:
+                    self.changelog = number
+            else:
+                self.add(number, line)
+
+    def preamble(self, number):
+        '''whether line number is in the main preamble or a %package one'''
+        section = None
+        for head, name in self.sections:
+            if head >= number:
+                break
+            section = name
+        return section in (None, 'package')
+
+    def keys(self, number, line):
+        '''(index, key) for every definition line makes at number'''
+        match = macro_re.match(line)
+        if match:
+            return [(self.macros, match.group('key'))]
+        match = tag_re.match(line)
+        if not match or not self.preamble(number):
+            return []
+        key = match.group('key').lower()
+        keys = [(self.tags, key)]
+        numbered = numbered_re.match(key)
+        if numbered:
+            kind, n = numbered.groups()
+            if kind == 'source':
+                keys.append((self.sources, int(n or 0)))
+            else:
+                keys.append((self.patches, int(n or 0)))
+        return keys
+
+    def add(self, number, line):
+        for index, key in self.keys(number, line):
+            numbers = index.setdefault(key, [])
+            if number not in numbers:
+                insort(numbers, number)
+
+    def remove(self, number, line):
+        for index, key in self.keys(number, line):
+            numbers = index.get(key, [])
+            if number in numbers:
+                numbers.remove(number)
+                if not numbers:
+                    del index[key]
+
+    def shift(self, after, delta):
+        for index in self.indexes():
+            for key, numbers in index.iteritems():
+                index[key] = [number + delta if number > after else number
+                              for number in numbers]
+        self.sections = [(number + delta if number > after else number, name)
+                         for number, name in self.sections]
+        if self.changelog is not None and self.changelog > after:
+            self.changelog += delta
+
+    def rewrite(self, number, lines):
+        '''replaces line number with lines'''
+        old = self.lines[number]
+        old_heads = section_re.match(old) and [old] or []
+        new_heads = [line for line in lines if section_re.match(line)]
+        if new_heads != old_heads or (old_heads and lines[0] != old):
+            self.lines[number:number + 1] = lines
+            return self.index()
+        self.remove(number, old)
+        self.lines[number:number + 1] = lines
+        if len(lines) != 1:
+            self.shift(number, len(lines) - 1)
+        for offset, line in enumerate(lines):
+            self.add(number + offset, line)
+
+    def value(self, index, key, regex):
+        '''the value of the first definition of key'''
+        numbers = index.get(key)
+        if not numbers:
+            return None
+        return regex.match(self.lines[numbers[0]]).group('value')
+
+    def tag(self, tag):
+        '''the value of a tag of the main package, None when it is not
+        there'''
+        return self.value(self.tags, tag.lower(), tag_re)
+
+    def macro(self, macro):
+        return self.value(self.macros, macro, macro_re)
+
+    def source_list(self, index):
+        return [(n, self.value(index, n, tag_re)) for n in sorted(index)]
+
+    def source_files(self):
+        '''(number, value) of the Source tags'''
+        return self.source_list(self.sources)
+
+    def patch_files(self):
+        '''(number, value) of the Patch tags'''
+        return self.source_list(self.patches)
+
+    def set_value(self, numbers, regex, value):
+        '''sets the value of every line in numbers'''
+        for number in list(numbers):
+            line = self.lines[number]
+            match = regex.match(line)
+            self.rewrite(number, [line[:match.start('value')] + value +
+                                  line[match.end('value'):]])
+
+    def set_tag(self, tag, value):
+        self.set_value(self.tags[tag.lower()], tag_re, value)
+
+    def set_macro(self, macro, value):
+        self.set_value(self.macros[macro], macro_re, value)
+
+
 class RPMSpec(object):
     def __init__(self, spec_file, defines=''):
         self.spec_file = spec_file
-        self.defines = ''
+        self.defines = defines_string(defines)
         self.contents = [x for x in file(spec_file)]
+        self._tags = None
+        self._parsed = None
+        self._document = None
+
+    def document(self):
+        '''the SpecDocument of the contents'''
+        if self._document is None:
+            self._document = SpecDocument(self.contents)
+        return self._document
+
+    def parsed(self):
+        '''the spec parsed in process by the rpm bindings, or None when
+        they are not available, are too old (see SPEC_PACKAGES) or cannot
+        parse it'''
+        if not SPEC_PACKAGES:
+            return None
+        if self._parsed is None:
+            try:
+                self._parsed = parse_spec(self.spec_file, self.defines)
+            except (ValueError, AttributeError, rpm.error), e:
+                log.debug('rpm could not parse %s: %s' % (self.spec_file, e))
+                return None
+        return self._parsed
 
     def query(self, tags):
+        '''a dict of the tags for every package the spec builds'''
+        spec = self.parsed()
+        if spec is not None:
+            try:
+                return [dict((tag, header_value(package.header, tag))
+                             for tag in tags) for package in spec.packages]
+            except AttributeError, e:
+                log.debug('rpm could not query %s: %s' % (self.spec_file, e))
         return query_specfile(self.spec_file, tags, self.defines)
 
     def query_one(self, *tags):
-        return query_specfile_one(self.spec_file, tags, self.defines)
+        if not [tag for tag in tags if tag not in QUERY_TAGS]:
+            found = self.tags()
+            return dict((tag, found[tag]) for tag in tags)
+        return self.query(tags)[0]
+
+    def cache_key(self):
+        digest = md5(''.join(self.contents)).hexdigest()
+        return (abspath(self.spec_file), getmtime(self.spec_file), digest,
+                self.defines)
+
+    def tags(self):
+        '''the QUERY_TAGS of the main package, all from one parse
+
+        the result is cached for as long as the spec file and the defines
+        stay the same, across RPMSpec objects too; the key is checked on
+        every call, so a spec changed by something else is queried again
+        '''
+        key = self.cache_key()
+        if self._tags is None or self._tags[0] != key:
+            tags = _spec_cache.get(key)
+            if tags is None:
+                tags = self.query(QUERY_TAGS)[0]
+                if len(tags) == len(QUERY_TAGS):
+                    if len(_spec_cache) >= MAX_CACHED_SPECS:
+                        _spec_cache.clear()
+                    _spec_cache[key] = tags
+            self._tags = (key, tags)
+        return self._tags[1]
 
     def query_one_field(self, field):
         return self.query_one(field)[field]
@@ -48,32 +343,47 @@ class RPMSpec(object):
         '''we force it to save each time, so commands that query via the shell
         have the most up to date version'''
         self.contents = list(contents)
+        self._document = None
+        self.save()
+
+    def set_document(self, document):
+        '''sets the contents to the lines of a SpecDocument, and saves'''
+        self.contents = document.lines
+        self._document = document
         self.save()
 
     def save(self):
-        with file(self.spec_file, 'w') as spec:
-            spec.writelines(self.contents)
+        '''writes the contents to a new file next to the spec and renames
+        it over the spec, so the spec is never seen half written'''
+        path = realpath(self.spec_file)
+        directory, name = os.path.split(path)
+        fd, temp = tempfile.mkstemp(prefix='.%s.' % name, dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as spec:
+                spec.writelines(self.contents)
+            if os.path.exists(path):
+                os.chmod(temp, stat.S_IMODE(os.stat(path).st_mode))
+            os.rename(temp, path)
+        except:
+            os.remove(temp)
+            raise
+        self._tags = None
+        self._parsed = None
 
     def version(self):
         return self.query_one_field('version')
 
     def version_line(self):
-        ver_line = [x for x in self.contents if x.startswith('Version:')][0]
-        ver_re = re.search(r'Version: (.*)', ver_line)
-        return ver_re.groups()[0]
+        return self.document().tag('Version')
 
     def set_version(self, version):
-        VersionProgram = ReplaceTagProgram('Version', version)
-        version_program = VersionProgram()
-        self.set_contents(version_program(self.contents))
+        self.edit().set_version(version).commit()
 
     def release(self):
         return self.query_one_field('release')
 
     def rel_line(self):
-        rel_line = [x for x in self.contents if x.startswith('Release:')][0]
-        rel_re = re.search(r'Release: (.*)', rel_line)
-        return rel_re.groups()[0]
+        return self.document().tag('Release')
 
     def ver_rel(self):
         ver_rel = self.query_one('version', 'release')
@@ -83,38 +393,161 @@ class RPMSpec(object):
         return self.query_one_field('name')
 
     def evr(self):
-        '''code taken from rpmdev-bumpspec'''
-        evr = self.query_one('epoch', 'version', 'release')
-        if evr['epoch'] != '(none)':
-            evr_out = evr['epoch'] + ':'
-        else:
-            evr_out = ''
-        return evr_out + evr['version'] + '-' + evr['release']
+        return format_evr(self.query_one('epoch', 'version', 'release'))
+
+    def edit(self):
+        '''a SpecEdit that makes several changes in one pass and one save'''
+        return SpecEdit(self)
 
     def increment_release(self, rightmost=False):
-        Program = BumpReleaseProgram(rightmost)
-        program = Program()
-        self.set_contents(program(self.contents))
+        self.edit().increment_release(rightmost).commit()
 
     def set_alphatag(self, alphatag):
-        Program = ReplaceMacroProgram('alphatag', alphatag)
-        program = Program()
-        self.set_contents(program(self.contents))
+        self.edit().set_alphatag(alphatag).commit()
 
     def add_changelog(self, entry, email):
-        evr = self.evr()
-        Program = ChangeLogProgram(evr, entry, email)
-        program = Program()
-        self.set_contents(program(self.contents))
+        self.edit().add_changelog(entry, email).commit()
 
     def bump_release(self, entry, email, rightmost=False):
-        self.increment_release(rightmost)
-        self.add_changelog(entry, email)
+        edit = self.edit()
+        edit.increment_release(rightmost)
+        edit.add_changelog(entry, email)
+        edit.commit()
 
     def sources(self):
-        ts = rpm.TransactionSet()
-        spec = ts.parseSpec(self.spec_file)
-        return spec.sources()
+        if rpm is None:
+            raise ImportError('listing the sources needs the rpm bindings')
+        spec = self._parsed or parse_spec(self.spec_file, self.defines)
+        # a method before rpm 4.9, a property since
+        sources = spec.sources
+        if callable(sources):
+            sources = sources()
+        return sources
+
+
+def format_evr(evr):
+    '''epoch:version-release, code taken from rpmdev-bumpspec'''
+    if evr['epoch'] != '(none)':
+        evr_out = evr['epoch'] + ':'
+    else:
+        evr_out = ''
+    return evr_out + evr['version'] + '-' + evr['release']
+
+
+class SpecEdit(object):
+    '''changes to an RPMSpec that are made together
+
+    every change is an Action for the lines its SpecDocument says it can
+    apply to; commit() runs them on a copy of the document, so only those
+    lines are looked at, and saves the spec once.  changelog entries are
+    added last, with the evr queried from the text the other changes made
+    (see evr).  as a context manager, the edit commits when the block
+    finishes without an error:
+
+        with spec.edit() as edit:
+            edit.increment_release()
+            edit.add_changelog('rebuilt', email)
+    '''
+    def __init__(self, spec):
+        self.spec = spec
+        self.actions = []
+        self.entries = []
+        self.edited = None
+        self._evr = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if kind is None:
+            self.commit()
+
+    def set_version(self, version):
+        self.actions.append((Action(Tag('Version'),
+                                    ReplaceValueHandler(version)),
+                             lambda document: document.tags.get('version', [])))
+        return self
+
+    def increment_release(self, rightmost=False):
+        def lines(document):
+            numbers = list(document.tags.get('release', []))
+            for macro in ('rel', 'release', 'baserelease'):
+                numbers.extend(document.macros.get(macro, []))
+            return numbers
+        self.actions.append((Action(BumpReleasePattern,
+                                    BumpReleaseHandler(rightmost)), lines))
+        return self
+
+    def set_alphatag(self, alphatag):
+        self.actions.append((Action(Macro('alphatag'),
+                                    ReplaceValueHandler(alphatag)),
+                             lambda document: document.macros.get('alphatag', [])))
+        return self
+
+    def add_changelog(self, entry, email):
+        self.entries.append((Action(ChangeLogPattern,
+                                    ChangeLogHandler(self.evr, entry, email)),
+                             lambda document: [document.changelog]))
+        return self
+
+    def evr(self):
+        '''the evr the spec will have once the other changes are made
+
+        when they change the text it is queried from a copy of the edited
+        spec, so the release and macros are expanded as rpm would; when
+        they do not, from the spec itself (and its cache)
+        '''
+        if self._evr is None:
+            document = self.edited
+            if document is None:
+                document = self.spec.document().copy()
+                self.apply(document, self.actions)
+            if document.lines == self.spec.contents:
+                evr = self.spec.query_one('epoch', 'version', 'release')
+            else:
+                evr = query_lines(self.spec, document.lines,
+                                  ('epoch', 'version', 'release'))
+            self._evr = format_evr(evr)
+        return self._evr
+
+    def apply(self, document, actions):
+        '''makes the changes of actions to a SpecDocument'''
+        for action, lines in actions:
+            numbers = [n for n in set(lines(document)) if n is not None]
+            for number in sorted(numbers, reverse=True):
+                result = action.match(None, document.lines[number])
+                if result is not None:
+                    document.rewrite(number, list(result))
+
+    def commit(self):
+        '''makes the changes and saves the spec'''
+        if not self.actions and not self.entries:
+            return
+        document = self.spec.document().copy()
+        self.apply(document, self.actions)
+        self.edited = document
+        try:
+            self.apply(document, self.entries)
+        finally:
+            self.edited = None
+            self._evr = None
+        self.spec.set_document(document)
+        self.actions = []
+        self.entries = []
+
+
+def query_lines(spec, lines, tags):
+    '''tags of the main package of spec as it would be with lines for its
+    contents, queried from a copy of it written next to it'''
+    directory, name = os.path.split(realpath(spec.spec_file))
+    fd, temp = tempfile.mkstemp(prefix='.%s.' % name, suffix='.spec',
+                                dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as copy:
+            copy.writelines(lines)
+        return RPMSpec(temp, spec.defines).query_one(*tags)
+    finally:
+        os.remove(temp)
 
 
 def format_querytag(tag):
@@ -146,11 +579,15 @@ class Tag(RegexPattern):
 
 
 class ReplaceValueHandler(BaseHandler):
+    stateless = True
+
     def __init__(self, value):
         self.value = value
 
     def __call__(self, awk, match, line):
-        yield line.replace(match.group('value'), self.value)
+        # only the value is replaced, not the same text elsewhere in the line
+        yield line[:match.start('value')] + self.value + \
+              line[match.end('value'):]
 
 
 class ReplaceAction(ActionOrPrint):
@@ -171,7 +608,8 @@ def ReplaceTagProgram(tag, value):
 
 class Macro(RegexPattern):
     def __init__(self, macro):
-        RegexPattern.__init__(self, r'^%%global (?P<key>%s) (?P<value>.*?)\n' % macro)
+        RegexPattern.__init__(self, r'^%%(?:global|define)\s+(?P<key>%s)\s+'
+                              r'(?P<value>.*?)\s*$' % macro)
 
 
 def ReplaceMacroProgram(macro, value):
@@ -194,6 +632,8 @@ class BumpSpecError(Exception):
     pass
 
 class BumpReleaseHandler(object):
+    stateless = True
+
     def __init__(self, rightmost=False):
         self.rightmost = rightmost
 
@@ -202,6 +642,10 @@ class BumpReleaseHandler(object):
 
     def increase(self, match):
         old = match.group('release')  # only the release value
+        # group 0 is the full line that defines the release
+        return old, self.increase_value(old)
+
+    def increase_value(self, old):
         try:
             if self.rightmost:
                 new = self.increaseFallback(old)
@@ -215,8 +659,7 @@ class BumpReleaseHandler(object):
             new = self.increaseFallback(old)
 #         if self.verbose:
 #             self.debugdiff(old, new)
-        # group 0 is the full line that defines the release
-        return old, new
+        return new
 
     def increaseMain(self, release):
         if release.startswith('0.'):
@@ -279,14 +722,19 @@ def BumpReleaseProgram(rightmost=False):
 ChangeLogPattern = RegexPattern(r"%changelog")
 
 class ChangeLogHandler(BaseHandler):
+    stateless = True
+
     def __init__(self, evr, entry, email):
         self.evr = evr
         self.entry = entry
         self.email = email
 
     def __call__(self, awk, match, line):
-        if len(self.evr):
-            evrstring = ' - %s' % self.evr
+        evr = self.evr
+        if callable(evr):
+            evr = evr()
+        if len(evr):
+            evrstring = ' - %s' % evr
         else:
             evrstring = ''
         yield line
@@ -312,8 +760,10 @@ def rpm_macros(**keys):
         log.debug('setting...')
         log.debug(key + ' ' + value)
         rpm.addMacro(key, value)
-    yield
-    for key, value in keys.iteritems():
-        rpm.delMacro(key)
+    try:
+        yield
+    finally:
+        for key, value in keys.iteritems():
+            rpm.delMacro(key)
 
-__all__ = ['rpm_macros', 'RPMSpec']
+__all__ = ['rpm_macros', 'RPMSpec', 'SpecEdit', 'SpecDocument']
@@ -0,0 +1,233 @@
+# Fedora Developer Shell
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+from __future__ import with_statement
+
+import os
+import tempfile
+import cPickle as pickle
+
+from hashlib import md5
+from os.path import join, abspath, exists, basename
+from multiprocessing import Pool, cpu_count
+
+from configobj import ConfigObj
+
+from devshell.base.base import log
+from devshell.base.factories import DirFactory
+from devshell.base.module import Module
+from devshell.base.rpm_utils import RPMSpec, defines_string
+from devshell.base.util import pwd
+from devshell.base.vars import FEDORA_DIR, DEVSHELL_DIR
+
+CACHE_FILE = join(DEVSHELL_DIR, 'bulk.cache')
+
+
+def find_packages(root):
+    '''(package directory, spec file) for every Package under root
+
+    the type is checked as Directory.is_sysdir_dir does, so the types of
+    subclasses such as rpmcvspackage count too'''
+    found = []
+    for path, dirs, files in os.walk(root):
+        if '.devshell' not in files:
+            continue
+        cfg = ConfigObj(join(path, '.devshell'))
+        if 'package' in cfg.get('type', '') and 'pkg_name' in cfg:
+            found.append((path, cfg['pkg_name'] + '.spec'))
+            # packages do not hold other packages, only their sources
+            dirs[:] = []
+    found.sort()
+    return found
+
+
+def spec_state(spec_file, known=None):
+    '''(mtime, size, md5) of a spec file; the md5 is taken from known when
+    the mtime and size are the same, so an untouched spec is not read.  the
+    contents are the same when the size and md5 are (see same_contents)'''
+    info = os.stat(spec_file)
+    if known and known[:2] == (info.st_mtime, info.st_size):
+        return known
+    with file(spec_file) as spec:
+        digest = md5(spec.read()).hexdigest()
+    return (info.st_mtime, info.st_size, digest)
+
+
+def same_contents(state, known):
+    return state[1:] == known[1:]
+
+
+def _run_job(job):
+    '''runs one package's query or edit in a worker process
+
+    returns (package directory, whether it worked, the result or the error,
+    the state of the spec after)'''
+    package_dir, spec_file, defines, query, edits = job
+    with pwd(package_dir):
+        try:
+            spec = RPMSpec(spec_file, defines)
+            if edits:
+                edit = spec.edit()
+                for method, args in edits:
+                    getattr(edit, method)(*args)
+                edit.commit()
+                spec = RPMSpec(spec_file, defines)
+            result = spec.query_one(*query)
+            ok = True
+        except Exception, e:
+            result = '%s: %s' % (e.__class__.__name__, e)
+            ok = False
+        state = exists(spec_file) and spec_state(spec_file) or None
+    return package_dir, ok, result, state
+
+
+class Bulk(Module):
+    '''queries and edits the spec files of every package under a directory
+    in a pool of processes
+
+    query results are kept in a cache in DEVSHELL_DIR, so running the same
+    query again skips the specs that have not changed since.  edits always
+    run, and replace what is cached for the specs they change
+    '''
+    def __init__(self, root=FEDORA_DIR, processes=None):
+        self.root = abspath(root)
+        self.processes = processes and int(processes) or cpu_count()
+        self.cache = self.load_cache()
+
+    def load_cache(self):
+        '''{spec file: {(query, defines): (spec_state, result)}}'''
+        if not exists(CACHE_FILE):
+            return {}
+        try:
+            with file(CACHE_FILE, 'rb') as cache:
+                return pickle.load(cache)
+        except Exception, e:
+            log.warn('ignoring the bulk cache, it could not be read: %s' % e)
+            return {}
+
+    def save_cache(self):
+        if not exists(DEVSHELL_DIR):
+            os.makedirs(DEVSHELL_DIR)
+        fd, temp = tempfile.mkstemp(prefix='.bulk.', dir=DEVSHELL_DIR)
+        try:
+            with os.fdopen(fd, 'wb') as cache:
+                pickle.dump(self.cache, cache, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp, CACHE_FILE)
+        except:
+            os.remove(temp)
+            raise
+
+    def close(self):
+        '''called by devshell, saves the cache'''
+        self.save_cache()
+
+    def clear_cache(self):
+        '''forgets the cached results, so the next run does every package'''
+        self.cache = {}
+        self.save_cache()
+
+    def packages(self):
+        '''lists the packages under the root directory'''
+        packages = find_packages(self.root)
+        for package_dir, spec_file in packages:
+            log.info(package_dir)
+        return packages
+
+    def run(self, query, edits=(), profile=None):
+        '''queries the tags in query from every package, after making the
+        edits, a list of (SpecEdit method, args), to it; returns
+        {package directory: (whether it worked, the result or the error)}
+        '''
+        if profile:
+            defines = defines_string(DirFactory(profile).dist_defines)
+        else:
+            defines = ''
+        operation = (tuple(query), defines)
+        results = {}
+        paths = {}
+        jobs = []
+        skipped = 0
+        for package_dir, spec_file in find_packages(self.root):
+            path = paths[package_dir] = join(package_dir, spec_file)
+            if not exists(path):
+                results[package_dir] = (False, 'no spec file %s' % spec_file)
+                continue
+            cached = not edits and self.cache.get(path, {}).get(operation)
+            state = cached and spec_state(path, cached[0])
+            if cached and same_contents(state, cached[0]):
+                if state != cached[0]:
+                    # only touched, the next run need not read it again
+                    self.cache[path][operation] = (state, cached[1])
+                results[package_dir] = (True, cached[1])
+                skipped += 1
+                continue
+            jobs.append((package_dir, spec_file, defines, query, edits))
+        if jobs:
+            pool = Pool(min(self.processes, len(jobs)))
+            try:
+                for package_dir, ok, result, state in \
+                        pool.imap_unordered(_run_job, jobs):
+                    results[package_dir] = (ok, result)
+                    path = paths[package_dir]
+                    if edits:
+                        # whatever was cached is for the spec before the edit
+                        self.cache.pop(path, None)
+                    if ok and state:
+                        cached = self.cache.setdefault(path, {})
+                        cached[operation] = (state, result)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+            self.save_cache()
+        self.report(query, results, skipped)
+        return results
+
+    def report(self, query, results, skipped=0):
+        failed = 0
+        for package_dir in sorted(results):
+            ok, result = results[package_dir]
+            name = basename(package_dir)
+            if ok:
+                log.info('%s: %s' % (name, ' '.join([result[tag]
+                                                     for tag in query])))
+            else:
+                failed += 1
+                log.error('%s: failed, %s' % (name, result))
+        log.info('%d packages, %d failed, %d unchanged since the last run'
+                 % (len(results), failed, skipped))
+
+    def query(self, *tags):
+        '''<tag> ... queries tags of every package'''
+        return self.run(tags)
+
+    def versions(self, profile=None):
+        '''[profile] reports the version-release of every package'''
+        return self.run(('version', 'release'), profile=profile)
+
+    def inc_rel(self):
+        '''increments the release of every package'''
+        return self.run(('release',), [('increment_release', ())])
+
+    def bump_rel(self, email, *entry):
+        '''<email> <entry> increments the release of every package and adds
+        a changelog entry'''
+        entry = ' '.join(entry)
+        return self.run(('version', 'release'),
+                        [('increment_release', ()),
+                         ('add_changelog', (entry, email))])
+
+__all__ = ['Bulk']